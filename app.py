@@ -1,52 +1,58 @@
 import streamlit as st
-import os
-import tempfile
 import pandas as pd
-import zipfile
 import json
 import re
-from pbit_parser import parse_pbit_file, extract_report_layout_from_zip
+from pbit_parser import json_loads
+from app_core import init_session_state, reset_file_state, clear_loaded_file, filter_dict_items, filter_index, filter_positions, search_index_matches, filter_pbix_frame, filter_pbix_table_names, build_search_index, snapshot_pbix_frames, build_relationships_df, build_columns_df, file_digest, get_pbit_metadata, get_pbix_file, get_pbix_table_head, get_pbix_full_table, get_metadata_context
 from chatbot_logic import (
     configure_gemini_model,
-    format_metadata_for_gemini,
     generate_gemini_response,
+    generate_gemini_response_stream,
+    construct_context_prelude,
     construct_initial_prompt,
     construct_reprompt_with_fetched_data,
     format_chat_history_for_prompt,
+    format_fetched_table_for_prompt,
     MAX_TOOL_FETCHED_ROWS_FOR_REPROMPT,
     MAX_CHAT_HISTORY_TURNS
 )
 
+EXPLORER_OPTIONS_BASE = ("Select an option...", "Tables & Columns", "Measures", "Calculated Columns", "Relationships", "M Queries", "Report Structure")
+EXPLORER_OPTIONS_PBIX_EXTRA = ("Table Data",)
+EXPLORER_OPTIONS_BY_FILE_TYPE = {"pbit": EXPLORER_OPTIONS_BASE, "pbix": EXPLORER_OPTIONS_BASE + EXPLORER_OPTIONS_PBIX_EXTRA}
+TABLE_PREVIEW_ROWS = 100 # Rows shown by the PBIX Table Data view before "Show all rows"
+EXPLORER_PAGE_SIZE = 25 # Tables / report pages rendered as expanders per explorer page
+CHAT_BOX_HEIGHT = 600 # Pixel height of the scrollable chat box
+CHAT_RECENT_MESSAGES = 30 # Chat messages rendered on each rerun before the "show older" toggle kicks in
+CHAT_LIVE_MESSAGES = 2 # Latest messages drawn as st.chat_message; earlier ones are batched into one markdown block
+TOOL_REQUEST_START_PATTERN = r"//\s*TOOL_REQUEST_START" # Shared by the stream filter and the parser so both agree on what starts a request
+TOOL_REQUEST_START_RE = re.compile(TOOL_REQUEST_START_PATTERN)
+TOOL_REQUEST_RE = re.compile(TOOL_REQUEST_START_PATTERN + r".*?(\{.*\}).*?//\s*TOOL_REQUEST_END", re.DOTALL) # Envelope around PBIXplorer's JSON data request; tolerates a code fence around the JSON
+CHAT_ROLE_LABELS = {"user": "🧑 **You**", "assistant": "🤖 **PBIXplorer**"}
+# Installs one MutationObserver on the app page (the component iframe is same-origin) that keeps the chat scrolled
+# to the newest message whenever a message is added or the streaming one grows; later loads find it already installed.
+CHAT_AUTOSCROLL_JS = """<script>
+(function() {
+    var doc = window.parent.document;
+    if (window.parent.pbixplorerAutoScroll) return;
+    window.parent.pbixplorerAutoScroll = true;
+    var lastCount = 0, lastLength = 0;
+    new MutationObserver(function() {
+        var messages = doc.querySelectorAll('[data-testid="stChatMessage"]');
+        if (!messages.length) return;
+        var lastLen = messages[messages.length - 1].textContent.length;
+        if (messages.length === lastCount && lastLen <= lastLength) return;
+        lastCount = messages.length; lastLength = lastLen;
+        messages[messages.length - 1].scrollIntoView({block: "end"}); // Also scrolls the fixed-height chat box
+    }).observe(doc.body, {childList: true, subtree: true, characterData: true});
+})();
+</script>"""
+
 # --- Page Configuration ---
 st.set_page_config(page_title="PBIXplorer Analysis Tool", layout="wide")
 
 # --- Session State Initialization ---
-if "gemini_api_key" not in st.session_state: st.session_state.gemini_api_key = ""
-if "gemini_configured" not in st.session_state: st.session_state.gemini_configured = False
-if "pbit_metadata" not in st.session_state: st.session_state.pbit_metadata = None
-if "pbix_object" not in st.session_state: st.session_state.pbix_object = None
-if "pbix_report_layout" not in st.session_state: st.session_state.pbix_report_layout = None
-if "active_file_type" not in st.session_state: st.session_state.active_file_type = None
-if "chat_history" not in st.session_state: st.session_state.chat_history = []
-if "uploaded_file_widget" not in st.session_state: st.session_state.uploaded_file_widget = None # Key for file_uploader widget
-if "original_uploaded_file_name" not in st.session_state: st.session_state.original_uploaded_file_name = None
-if "explorer_search_term" not in st.session_state: st.session_state.explorer_search_term = ""
-if "explorer_option" not in st.session_state: st.session_state.explorer_option = "Select an option..."
-if "run_id" not in st.session_state: st.session_state.run_id = 0
-if "sidebar_pbix_table_select_viewer" not in st.session_state: st.session_state.sidebar_pbix_table_select_viewer = "Select a table..."
-if "current_metadata_context_string" not in st.session_state: st.session_state.current_metadata_context_string = ""
-if "pending_rag_reprompt_details" not in st.session_state:
-    st.session_state.pending_rag_reprompt_details = None
-
-# --- Helper function for filtering dictionary items ---
-def filter_dict_items(items_dict, search_term):
-    if not search_term: return items_dict
-    search_term_lower = search_term.lower()
-    return {
-        k: v for k, v in items_dict.items()
-        if search_term_lower in str(k).lower() or
-           (isinstance(v, str) and search_term_lower in v.lower())
-    }
+init_session_state()
 
 # --- Sidebar UI ---
 st.sidebar.title("📊 PBIXplorer Analysis Tool")
@@ -79,354 +85,403 @@ st.sidebar.subheader("File Upload")
 
 # --- File Upload & Processing ---
 def on_file_upload_clear():
-    if st.session_state.active_file_type is not None:
-        st.session_state.pbit_metadata = None; st.session_state.pbix_object = None
-        st.session_state.pbix_report_layout = None; st.session_state.active_file_type = None
-        st.session_state.original_uploaded_file_name = None; st.session_state.current_metadata_context_string = ""
-        st.session_state.chat_history = []; st.session_state.explorer_option = "Select an option..."
-        st.session_state.explorer_search_term = ""; st.session_state.sidebar_pbix_table_select_viewer = "Select a table..."
-        st.session_state.pending_rag_reprompt_details = None; st.session_state.run_id += 1
+    if st.session_state.active_file_type is not None: reset_file_state()
 
 uploaded_file = st.sidebar.file_uploader(
     "Choose a .pbit or .pbix file", type=["pbit", "pbix"],
-    key="uploaded_file_widget_ui_v4", on_change=on_file_upload_clear
+    key=f"uploaded_file_widget_ui_v4_{st.session_state.uploader_generation}", on_change=on_file_upload_clear
 )
+clear_button_slot = st.sidebar.empty() # Filled after processing, so the button shows up on the same run that loads a file
 
 if uploaded_file is not None:
     if st.session_state.original_uploaded_file_name != uploaded_file.name or not st.session_state.active_file_type:
-        st.session_state.original_uploaded_file_name = uploaded_file.name
-        st.session_state.pbit_metadata = None; st.session_state.pbix_object = None
-        st.session_state.pbix_report_layout = None; st.session_state.active_file_type = None
-        st.session_state.current_metadata_context_string = ""; st.session_state.pending_rag_reprompt_details = None
-        st.session_state.explorer_option = "Select an option..."; st.session_state.sidebar_pbix_table_select_viewer = "Select a table..."
-        st.session_state.run_id += 1
+        reset_file_state(); st.session_state.original_uploaded_file_name = uploaded_file.name
         initial_bot_message = f"Processing '{uploaded_file.name}'..."
         st.session_state.chat_history = [{"role": "assistant", "content": initial_bot_message}]
 
         with st.spinner(f"Analyzing '{uploaded_file.name}'... This may take a moment."):
-            file_extension = os.path.splitext(uploaded_file.name)[1]
-            with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as tmp_file:
-                tmp_file.write(uploaded_file.getvalue()); temp_file_path = tmp_file.name
-            
             report_layout_info_msg = ""; initial_bot_message = f"Okay, I've analyzed **{uploaded_file.name}**. How can I help?"
             processed_data_for_gemini = None
             try:
+                # The upload is already an in-memory BytesIO: hash its buffer without copying and hand the stream itself to the parsers (no temp file)
+                with uploaded_file.getbuffer() as upload_buffer: st.session_state.file_hash = file_digest(upload_buffer) # Keys every per-file cache, PBIT and PBIX alike
                 if uploaded_file.name.endswith(".pbit"):
-                    metadata = parse_pbit_file(temp_file_path)
+                    metadata = get_pbit_metadata(st.session_state.file_hash, uploaded_file.name, uploaded_file)
                     if metadata: st.session_state.pbit_metadata = metadata; st.session_state.active_file_type = "pbit"; processed_data_for_gemini = metadata; st.sidebar.success(f"PBIT '{uploaded_file.name}' parsed!")
                     else: initial_bot_message = f"Could not fully parse PBIT '{uploaded_file.name}'."; st.sidebar.error(f"PBIT parsing failed for {uploaded_file.name}.")
                 elif uploaded_file.name.endswith(".pbix"):
-                    from pbixray_lib.core import PBIXRay
-                    pbix_obj = PBIXRay(temp_file_path)
+                    pbix_obj, report_pages = get_pbix_file(st.session_state.file_hash, uploaded_file)
                     if pbix_obj:
                         st.session_state.pbix_object = pbix_obj; st.session_state.active_file_type = "pbix"; processed_data_for_gemini = pbix_obj
-                        try:
-                            with zipfile.ZipFile(temp_file_path, 'r') as pbix_zip:
-                                st.session_state.pbix_report_layout = extract_report_layout_from_zip(pbix_zip)
-                                if st.session_state.pbix_report_layout: report_layout_info_msg = " Report layout also parsed."
-                                else: report_layout_info_msg = " Report layout not found/parsed."
-                        except Exception: report_layout_info_msg = " Note: Error parsing report layout."
+                        st.session_state.pbix_report_layout = report_pages
+                        if report_pages is None: report_layout_info_msg = " Note: Error parsing report layout."
+                        elif report_pages: report_layout_info_msg = " Report layout also parsed."
+                        else: report_layout_info_msg = " Report layout not found/parsed."
                         initial_bot_message = f"PBIX file **{uploaded_file.name}** analyzed.{report_layout_info_msg} Ready for your questions!"
                         st.sidebar.success(f"PBIX '{uploaded_file.name}' parsed!{report_layout_info_msg}")
                     else: initial_bot_message = f"Could not initialize PBIXRay for '{uploaded_file.name}'."; st.sidebar.error(f"PBIX processing failed for {uploaded_file.name}.")
                 
                 if st.session_state.active_file_type and processed_data_for_gemini:
-                    st.session_state.current_metadata_context_string = format_metadata_for_gemini(
-                        processed_data_for_gemini, st.session_state.active_file_type, uploaded_file.name,
+                    st.session_state.current_metadata_context_string = get_metadata_context(
+                        st.session_state.file_hash, st.session_state.active_file_type, uploaded_file.name, processed_data_for_gemini,
                         st.session_state.pbix_report_layout if st.session_state.active_file_type == "pbix" else None)
+                    st.session_state.current_context_prelude = construct_context_prelude(st.session_state.current_metadata_context_string) # Built once per file; every prompt starts with it
                 else: st.session_state.original_uploaded_file_name = None
             except Exception as e:
                 initial_bot_message = f"Error processing '{uploaded_file.name}': {e}"; st.sidebar.error(f"Processing error: {e}")
                 st.session_state.active_file_type = None; st.session_state.original_uploaded_file_name = None
-            finally:
-                if os.path.exists(temp_file_path): os.remove(temp_file_path)
             st.session_state.chat_history = [{"role": "assistant", "content": initial_bot_message}]
-            st.rerun()
 elif st.session_state.original_uploaded_file_name is not None and uploaded_file is None:
-    if st.session_state.active_file_type is not None: on_file_upload_clear(); st.rerun()
+    if st.session_state.active_file_type is not None: on_file_upload_clear()
+if st.session_state.active_file_type: clear_button_slot.button("Clear loaded file", on_click=clear_loaded_file, help="Unload the file and reset the explorer and chat")
 
 
 # --- Interactive Metadata Explorer in Sidebar ---
-if st.session_state.active_file_type:
-    st.sidebar.markdown("---"); st.sidebar.subheader("🔍 Explore Metadata")
-    EXPLORER_OPTIONS_BASE = ("Select an option...", "Tables & Columns", "Measures", "Calculated Columns", "Relationships", "M Queries", "Report Structure")
-    EXPLORER_OPTIONS_PBIX_EXTRA = ("Table Data",)
-    if st.session_state.active_file_type == "pbit": EXPLORER_OPTIONS = EXPLORER_OPTIONS_BASE
-    elif st.session_state.active_file_type == "pbix": EXPLORER_OPTIONS = EXPLORER_OPTIONS_BASE + EXPLORER_OPTIONS_PBIX_EXTRA
-    else: EXPLORER_OPTIONS = ("Select an option...",)
-    def on_explorer_option_change_sb():
-        st.session_state.explorer_search_term = ""
-        if st.session_state.explorer_option != "Table Data": st.session_state.sidebar_pbix_table_select_viewer = "Select a table..."
-    st.sidebar.selectbox("Choose metadata:", options=EXPLORER_OPTIONS, key="explorer_option", on_change=on_explorer_option_change_sb)
-    if st.session_state.explorer_option != "Table Data": st.sidebar.text_input("Search current view:", key="explorer_search_term")
+def on_explorer_option_change():
+    # Only the search term carries over between views; the Table Data selectbox is not rendered elsewhere, so Streamlit already drops its state
+    st.session_state.explorer_search_term = ""
+
+def pick_row(listing_df, key):
+    """Renders listing_df as one selectable table and returns the selected row position, or None (one widget instead of an expander per item)."""
+    event = st.dataframe(listing_df, use_container_width=True, hide_index=True, height=min(300, (len(listing_df) + 1) * 35 + 3), on_select="rerun", selection_mode="single-row", key=key)
+    rows = [row for row in event.selection.rows if row < len(listing_df)]
+    if not rows: st.caption("Select a row to view its details."); return None
+    return rows[0]
+
+def page_slice(count, key):
+    """Returns the slice of items on the current explorer page; the page selector only appears past EXPLORER_PAGE_SIZE items."""
+    if count <= EXPLORER_PAGE_SIZE: return slice(0, count)
+    page_count = -(-count // EXPLORER_PAGE_SIZE)
+    page = st.number_input(f"Page (of {page_count}, {count} items)", min_value=1, max_value=page_count, value=1, step=1, key=key)
+    return slice((page - 1) * EXPLORER_PAGE_SIZE, page * EXPLORER_PAGE_SIZE)
+
+@st.fragment
+def render_metadata_explorer():
+    """Renders the sidebar explorer as a fragment so its widgets (search, option, table select) rerun only this block."""
+    st.markdown("---"); st.subheader("🔍 Explore Metadata")
+    st.selectbox("Choose metadata:", options=EXPLORER_OPTIONS_BY_FILE_TYPE.get(st.session_state.active_file_type, ("Select an option...",)), key="explorer_option", on_change=on_explorer_option_change)
+    if st.session_state.explorer_option != "Table Data":
+        with st.form("explorer_search_form", border=False): # Batches the term into one fragment rerun on Enter/Filter
+            st.text_input("Search current view:", key="explorer_search_term"); st.form_submit_button("Filter")
     search_term_sb = st.session_state.explorer_search_term.lower()
+    if st.session_state.explorer_search_index is None:
+        st.session_state.explorer_search_index = build_search_index(st.session_state.pbit_metadata if st.session_state.active_file_type == "pbit" and st.session_state.pbit_metadata else {"report_pages": st.session_state.pbix_report_layout or []})
+    search_index_sb = st.session_state.explorer_search_index
+    if st.session_state.active_file_type == "pbix" and st.session_state.pbix_object and st.session_state.pbix_frames is None:
+        st.session_state.pbix_frames = snapshot_pbix_frames(st.session_state.pbix_object)
+    pbix_frames_sb = st.session_state.pbix_frames
     
     # Tables & Columns
     if st.session_state.explorer_option == "Tables & Columns":
-        st.sidebar.markdown("##### Tables and Columns")
+        st.markdown("##### Tables and Columns")
         if st.session_state.active_file_type == "pbit" and st.session_state.pbit_metadata:
-            metadata_sb_pbit = st.session_state.pbit_metadata; all_tables = sorted(metadata_sb_pbit.get("tables", []), key=lambda x: x.get("name", ""))
-            filtered_tables = [t for t in all_tables if not search_term_sb or search_term_sb in t.get("name", "").lower() or any(search_term_sb in col.get("name","").lower() or search_term_sb in col.get("dataType","").lower() for col in t.get("columns",[]))] if metadata_sb_pbit.get("tables") else []
+            metadata_sb_pbit = st.session_state.pbit_metadata
+            filtered_tables = filter_index(st.session_state.file_hash, "tables", search_term_sb, search_index_sb)
             if filtered_tables:
-                for table in filtered_tables:
+                for table in filtered_tables[page_slice(len(filtered_tables), f"tables_page_{search_term_sb}")]: # Keyed on the term so a new filter starts at page 1
                     table_name = table.get("name", "Unknown Table")
-                    with st.sidebar.expander(f"Table: **{table_name}** ({len(table.get('columns',[]))} columns)"):
-                        if table.get("columns"): cols_data = [{"Column Name": col.get("name"), "Data Type": col.get("dataType")} for col in table["columns"]]; st.dataframe(pd.DataFrame(cols_data), use_container_width=True, height=min(250, (len(cols_data) + 1) * 35 + 3))
+                    with st.expander(f"Table: **{table_name}** ({len(table.get('columns',[]))} columns)"):
+                        if table.get("columns"): cols_df = build_columns_df(st.session_state.file_hash, table_name, table["columns"]); st.dataframe(cols_df, use_container_width=True, height=min(250, (len(cols_df) + 1) * 35 + 3))
                         else: st.write("No columns found.")
-            elif search_term_sb and metadata_sb_pbit.get("tables"): st.sidebar.info(f"No tables/columns match '{st.session_state.explorer_search_term}'.")
-            elif not metadata_sb_pbit.get("tables"): st.sidebar.info("No table information found.")
+            elif search_term_sb and metadata_sb_pbit.get("tables"): st.info(f"No tables/columns match '{st.session_state.explorer_search_term}'.")
+            elif not metadata_sb_pbit.get("tables"): st.info("No table information found.")
         elif st.session_state.active_file_type == "pbix" and st.session_state.pbix_object:
-            pbix_md = st.session_state.pbix_object; all_table_names_pbix = sorted(list(pbix_md.tables)); schema_df = pbix_md.schema
-            filtered_table_names = [name for name in all_table_names_pbix if not search_term_sb or search_term_sb in name.lower() or any((search_term_sb in col_info['ColumnName'].lower() or search_term_sb in col_info['PandasDataType'].lower()) for _, col_info in schema_df[schema_df['TableName'] == name].iterrows())]
+            all_table_names_pbix = pbix_frames_sb["table_names"]; columns_by_table = pbix_frames_sb["columns_by_table"]
+            filtered_table_names = filter_pbix_table_names(st.session_state.file_hash, search_term_sb, pbix_frames_sb) if search_term_sb else all_table_names_pbix
             if filtered_table_names:
-                for table_name in filtered_table_names:
-                    table_columns_df = schema_df[schema_df['TableName'] == table_name]
-                    with st.sidebar.expander(f"Table: **{table_name}** ({len(table_columns_df)} columns)"):
-                        if not table_columns_df.empty: cols_data = [{"Column Name": row["ColumnName"], "Data Type": row["PandasDataType"]} for _, row in table_columns_df.iterrows()]; st.dataframe(pd.DataFrame(cols_data), use_container_width=True, height=min(250, (len(cols_data) + 1) * 35 + 3))
+                for table_name in filtered_table_names[page_slice(len(filtered_table_names), f"pbix_tables_page_{search_term_sb}")]:
+                    cols_view = columns_by_table.get(table_name) # Tables without columns have no schema group
+                    with st.expander(f"Table: **{table_name}** ({0 if cols_view is None else len(cols_view)} columns)"):
+                        if cols_view is not None: st.dataframe(cols_view, use_container_width=True, height=min(250, (len(cols_view) + 1) * 35 + 3))
                         else: st.write("No columns found.")
-            elif search_term_sb and all_table_names_pbix: st.sidebar.info(f"No PBIX tables/columns match '{st.session_state.explorer_search_term}'.")
-            elif not all_table_names_pbix: st.sidebar.info("No table information found in PBIX.")
+            elif search_term_sb and all_table_names_pbix: st.info(f"No PBIX tables/columns match '{st.session_state.explorer_search_term}'.")
+            elif not all_table_names_pbix: st.info("No table information found in PBIX.")
     # Measures
     elif st.session_state.explorer_option == "Measures":
-        st.sidebar.markdown("##### DAX Measures")
+        st.markdown("##### DAX Measures")
         if st.session_state.active_file_type == "pbit" and st.session_state.pbit_metadata:
-            metadata_sb_pbit = st.session_state.pbit_metadata; all_measures = metadata_sb_pbit.get("measures", {}); filtered_measures = filter_dict_items(all_measures, search_term_sb)
+            metadata_sb_pbit = st.session_state.pbit_metadata; all_measures = metadata_sb_pbit.get("measures", {}); filtered_measures = filter_dict_items(all_measures, search_term_sb, st.session_state.file_hash, "measures", search_index_sb)
             if filtered_measures:
-                for measure_name, formula in sorted(filtered_measures.items()):
-                    with st.sidebar.expander(f"Measure: **{measure_name}**"): st.code(formula, language="dax")
-            elif search_term_sb and all_measures : st.sidebar.info(f"No measures match '{st.session_state.explorer_search_term}'.")
-            elif not all_measures : st.sidebar.info("No DAX measures found.")
+                measure_names = list(filtered_measures); picked = pick_row(pd.DataFrame({"Measure": measure_names}), f"measures_pick_{search_term_sb}") # Keyed on the term so a new filter clears the selection
+                if picked is not None: st.markdown(f"Measure: **{measure_names[picked]}**"); st.code(filtered_measures[measure_names[picked]], language="dax")
+            elif search_term_sb and all_measures : st.info(f"No measures match '{st.session_state.explorer_search_term}'.")
+            elif not all_measures : st.info("No DAX measures found.")
         elif st.session_state.active_file_type == "pbix" and st.session_state.pbix_object:
-            pbix_md = st.session_state.pbix_object; dax_measures_df = pbix_md.dax_measures
+            dax_measures_df = pbix_frames_sb["dax_measures"]
             if dax_measures_df is not None and not dax_measures_df.empty:
-                filtered_measures_df = dax_measures_df[dax_measures_df.apply(lambda row: search_term_sb in f"{row['TableName']}.{row['Name']}".lower() or search_term_sb in str(row['Expression']).lower() or search_term_sb in str(row['DisplayFolder']).lower(), axis=1)] if search_term_sb else dax_measures_df
+                filtered_measures_df = filter_pbix_frame(st.session_state.file_hash, "dax_measures", search_term_sb, pbix_frames_sb) if search_term_sb else dax_measures_df
                 if not filtered_measures_df.empty:
-                    for _, row in filtered_measures_df.sort_values(by=['TableName', 'Name']).iterrows():
-                        measure_qual_name = f"{row['TableName']}.{row['Name']}"
-                        with st.sidebar.expander(f"Measure: **{measure_qual_name}**"):
-                            if pd.notna(row['DisplayFolder']): st.caption(f"Display Folder: {row['DisplayFolder']}")
-                            if pd.notna(row['Description']): st.caption(f"Description: {row['Description']}")
-                            st.code(row['Expression'], language="dax")
-                elif search_term_sb: st.sidebar.info(f"No PBIX measures match '{st.session_state.explorer_search_term}'.")
-            else: st.sidebar.info("No DAX measures found in PBIX.")
+                    picked = pick_row(filtered_measures_df[["TableName", "Name", "DisplayFolder"]].rename(columns={"TableName": "Table", "Name": "Measure", "DisplayFolder": "Display Folder"}), f"pbix_measures_pick_{search_term_sb}")
+                    if picked is not None:
+                        row = filtered_measures_df.iloc[picked]; st.markdown(f"Measure: **{row['TableName']}.{row['Name']}**")
+                        if pd.notna(row['DisplayFolder']): st.caption(f"Display Folder: {row['DisplayFolder']}")
+                        if pd.notna(row['Description']): st.caption(f"Description: {row['Description']}")
+                        st.code(row['Expression'], language="dax")
+                elif search_term_sb: st.info(f"No PBIX measures match '{st.session_state.explorer_search_term}'.")
+            else: st.info("No DAX measures found in PBIX.")
     # Calculated Columns
     elif st.session_state.explorer_option == "Calculated Columns":
-        st.sidebar.markdown("##### Calculated Columns")
+        st.markdown("##### Calculated Columns")
         if st.session_state.active_file_type == "pbit" and st.session_state.pbit_metadata:
-            pbit_meta = st.session_state.pbit_metadata; all_cc = pbit_meta.get("calculated_columns", {}); filtered_cc = filter_dict_items(all_cc, search_term_sb)
+            pbit_meta = st.session_state.pbit_metadata; all_cc = pbit_meta.get("calculated_columns", {}); filtered_cc = filter_dict_items(all_cc, search_term_sb, st.session_state.file_hash, "calculated_columns", search_index_sb)
             if filtered_cc:
-                for cc_name, formula in sorted(filtered_cc.items()):
-                    with st.sidebar.expander(f"Calculated Column: **{cc_name}**"): st.code(formula, language="dax")
-            elif search_term_sb and all_cc : st.sidebar.info(f"No PBIT CCs match '{st.session_state.explorer_search_term}'.")
-            elif not all_cc : st.sidebar.info("No PBIT CCs found.")
+                cc_names = list(filtered_cc); picked = pick_row(pd.DataFrame({"Calculated Column": cc_names}), f"cc_pick_{search_term_sb}")
+                if picked is not None: st.markdown(f"Calculated Column: **{cc_names[picked]}**"); st.code(filtered_cc[cc_names[picked]], language="dax")
+            elif search_term_sb and all_cc : st.info(f"No PBIT CCs match '{st.session_state.explorer_search_term}'.")
+            elif not all_cc : st.info("No PBIT CCs found.")
         elif st.session_state.active_file_type == "pbix" and st.session_state.pbix_object:
-            pbix_obj = st.session_state.pbix_object; dax_columns_df = pbix_obj.dax_columns
+            dax_columns_df = pbix_frames_sb["dax_columns"]
             if dax_columns_df is not None and not dax_columns_df.empty:
-                filtered_cc_df = dax_columns_df[dax_columns_df.apply(lambda row: search_term_sb in f"{row['TableName']}.{row['ColumnName']}".lower() or search_term_sb in str(row['Expression']).lower(), axis=1)] if search_term_sb else dax_columns_df
+                filtered_cc_df = filter_pbix_frame(st.session_state.file_hash, "dax_columns", search_term_sb, pbix_frames_sb) if search_term_sb else dax_columns_df
                 if not filtered_cc_df.empty:
-                    for _, row in filtered_cc_df.sort_values(by=['TableName', 'ColumnName']).iterrows():
-                        cc_qual_name = f"{row['TableName']}.{row['ColumnName']}"
-                        with st.sidebar.expander(f"Calculated Column: **{cc_qual_name}**"): st.code(row['Expression'], language="dax")
-                elif search_term_sb: st.sidebar.info(f"No PBIX CCs match '{st.session_state.explorer_search_term}'.")
-            else: st.sidebar.info("No CCs found in PBIX.")
+                    picked = pick_row(filtered_cc_df[["TableName", "ColumnName"]].rename(columns={"TableName": "Table", "ColumnName": "Calculated Column"}), f"pbix_cc_pick_{search_term_sb}")
+                    if picked is not None: row = filtered_cc_df.iloc[picked]; st.markdown(f"Calculated Column: **{row['TableName']}.{row['ColumnName']}**"); st.code(row['Expression'], language="dax")
+                elif search_term_sb: st.info(f"No PBIX CCs match '{st.session_state.explorer_search_term}'.")
+            else: st.info("No CCs found in PBIX.")
     # M Queries
     elif st.session_state.explorer_option == "M Queries" or st.session_state.explorer_option == "M Queries (Power Query)":
-        st.sidebar.markdown("##### M (Power Query) Scripts")
+        st.markdown("##### M (Power Query) Scripts")
         if st.session_state.active_file_type == "pbit" and st.session_state.pbit_metadata:
-            metadata_sb_pbit = st.session_state.pbit_metadata; all_m_queries = sorted(metadata_sb_pbit.get("m_queries", []), key=lambda x: x.get("table_name", ""))
-            filtered_m_queries = [mq for mq in all_m_queries if not search_term_sb or search_term_sb in mq.get("table_name","").lower() or search_term_sb in mq.get("script","").lower() or any(search_term_sb in s.lower() for s in mq.get("analysis",{}).get("sources",[])) or any(search_term_sb in t.lower() for t in mq.get("analysis",{}).get("transformations",[]))]
+            metadata_sb_pbit = st.session_state.pbit_metadata
+            filtered_m_queries = filter_index(st.session_state.file_hash, "m_queries", search_term_sb, search_index_sb)
             if filtered_m_queries:
-                for mq_info in filtered_m_queries:
-                    with st.sidebar.expander(f"M Query for Table: **{mq_info.get('table_name', '?')}**"):
-                        analysis = mq_info.get("analysis", {}); st.markdown(f"**Identified Sources:** {', '.join(analysis.get('sources', ['N/A']))}"); st.markdown(f"**Common Transformations:** {', '.join(analysis.get('transformations', ['N/A']))}"); st.markdown("**Script:**"); st.code(mq_info.get("script", "N/A"), language="powerquery")
-            elif search_term_sb and metadata_sb_pbit.get("m_queries"): st.sidebar.info(f"No M Queries match '{st.session_state.explorer_search_term}'.")
-            elif not metadata_sb_pbit.get("m_queries"): st.sidebar.info("No M Query information found.")
+                picked = pick_row(pd.DataFrame({"Table": [mq_info.get("table_name", "?") for mq_info in filtered_m_queries]}), f"mq_pick_{search_term_sb}")
+                if picked is not None:
+                    mq_info = filtered_m_queries[picked]; st.markdown(f"M Query for Table: **{mq_info.get('table_name', '?')}**")
+                    analysis = mq_info.get("analysis", {}); st.markdown(f"**Identified Sources:** {', '.join(analysis.get('sources', ['N/A']))}"); st.markdown(f"**Common Transformations:** {', '.join(analysis.get('transformations', ['N/A']))}"); st.markdown("**Script:**"); st.code(mq_info.get("script", "N/A"), language="powerquery")
+            elif search_term_sb and metadata_sb_pbit.get("m_queries"): st.info(f"No M Queries match '{st.session_state.explorer_search_term}'.")
+            elif not metadata_sb_pbit.get("m_queries"): st.info("No M Query information found.")
         elif st.session_state.active_file_type == "pbix" and st.session_state.pbix_object:
-            pbix_md = st.session_state.pbix_object; power_query_df = pbix_md.power_query
+            power_query_df = pbix_frames_sb["power_query"]
             if power_query_df is not None and not power_query_df.empty:
-                filtered_pq_df = power_query_df[power_query_df.apply(lambda row: search_term_sb in str(row['TableName']).lower() or search_term_sb in str(row['Expression']).lower(), axis=1)] if search_term_sb else power_query_df
+                filtered_pq_df = filter_pbix_frame(st.session_state.file_hash, "power_query", search_term_sb, pbix_frames_sb) if search_term_sb else power_query_df
                 if not filtered_pq_df.empty:
-                    for _, row in filtered_pq_df.sort_values(by='TableName').iterrows():
-                        with st.sidebar.expander(f"M Query for Table: **{row['TableName']}**"): st.code(row['Expression'], language="powerquery")
-                elif search_term_sb: st.sidebar.info(f"No PBIX M Queries match '{st.session_state.explorer_search_term}'.")
-            else: st.sidebar.info("No M Query information found in PBIX.")
+                    picked = pick_row(filtered_pq_df[["TableName"]].rename(columns={"TableName": "Table"}), f"pbix_mq_pick_{search_term_sb}")
+                    if picked is not None: row = filtered_pq_df.iloc[picked]; st.markdown(f"M Query for Table: **{row['TableName']}**"); st.code(row['Expression'], language="powerquery")
+                elif search_term_sb: st.info(f"No PBIX M Queries match '{st.session_state.explorer_search_term}'.")
+            else: st.info("No M Query information found in PBIX.")
     # Relationships
     elif st.session_state.explorer_option == "Relationships":
-        st.sidebar.markdown("##### Relationships")
+        st.markdown("##### Relationships")
         if st.session_state.active_file_type == "pbit" and st.session_state.pbit_metadata:
             metadata_sb_pbit = st.session_state.pbit_metadata; all_rels = metadata_sb_pbit.get("relationships", [])
-            if not all_rels: st.sidebar.info("No relationships found.")
+            if not all_rels: st.info("No relationships found.")
             else:
-                filtered_rels = [r for r in all_rels if not search_term_sb or search_term_sb in str(r.get("fromTable","")).lower() or search_term_sb in str(r.get("toTable","")).lower() or search_term_sb in str(r.get("fromColumn","")).lower() or search_term_sb in str(r.get("toColumn","")).lower()]
-                if filtered_rels:
-                    rels_data = [{"From": f"{r.get('fromTable','?')}.{r.get('fromColumn','?')}", "To": f"{r.get('toTable','?')}.{r.get('toColumn','?')}", "Active": r.get("isActive", True), "Filter Dir.": r.get("crossFilteringBehavior", "N/A")} for r in filtered_rels]
-                    st.sidebar.dataframe(pd.DataFrame(rels_data), use_container_width=True, height=min(300, (len(rels_data) + 1) * 35 + 3))
-                elif search_term_sb: st.sidebar.info(f"No relationships match '{st.session_state.explorer_search_term}'.")
+                rels_df = build_relationships_df(st.session_state.file_hash, all_rels)
+                filtered_rels_df = rels_df.iloc[search_index_matches(st.session_state.file_hash, "relationships", search_term_sb, search_index_sb)] if search_term_sb else rels_df
+                if not filtered_rels_df.empty:
+                    st.dataframe(filtered_rels_df, use_container_width=True, height=min(300, (len(filtered_rels_df) + 1) * 35 + 3))
+                elif search_term_sb: st.info(f"No relationships match '{st.session_state.explorer_search_term}'.")
         elif st.session_state.active_file_type == "pbix" and st.session_state.pbix_object:
-            pbix_md = st.session_state.pbix_object; relationships_df = pbix_md.relationships
+            relationships_df = pbix_frames_sb["relationships"]
             if relationships_df is not None and not relationships_df.empty:
-                filtered_rels_df = relationships_df[relationships_df.apply(lambda row: search_term_sb in str(row['FromTableName']).lower() or search_term_sb in str(row['FromColumnName']).lower() or search_term_sb in str(row['ToTableName']).lower() or search_term_sb in str(row['ToColumnName']).lower(), axis=1)] if search_term_sb else relationships_df
+                filtered_rels_df = filter_pbix_frame(st.session_state.file_hash, "relationships", search_term_sb, pbix_frames_sb) if search_term_sb else relationships_df
                 if not filtered_rels_df.empty:
-                    rels_data_pbix = [{"From": f"{r_item.get('FromTableName','?')}.{r_item.get('FromColumnName','?')}", "To": f"{r_item.get('ToTableName','?')}.{r_item.get('ToColumnName','?')}", "Active": r_item.get("IsActive", True), "Cardinality": r_item.get("Cardinality", "N/A"), "Filter Dir.": r_item.get("CrossFilteringBehavior", "N/A")} for _, r_item in filtered_rels_df.iterrows()]
-                    st.sidebar.dataframe(pd.DataFrame(rels_data_pbix), use_container_width=True, height=min(300, (len(rels_data_pbix) + 1) * 35 + 3))
-                elif search_term_sb: st.sidebar.info(f"No PBIX relationships match '{st.session_state.explorer_search_term}'.")
-            else: st.sidebar.info("No relationships found in PBIX.")
+                    rels_view_pbix = pd.DataFrame({"From": filtered_rels_df["FromTableName"].fillna("?").astype(str) + "." + filtered_rels_df["FromColumnName"].fillna("?").astype(str), "To": filtered_rels_df["ToTableName"].fillna("?").astype(str) + "." + filtered_rels_df["ToColumnName"].fillna("?").astype(str), "Active": filtered_rels_df["IsActive"], "Cardinality": filtered_rels_df["Cardinality"], "Filter Dir.": filtered_rels_df["CrossFilteringBehavior"]}) # Column-wise, no per-row dicts
+                    st.dataframe(rels_view_pbix, use_container_width=True, height=min(300, (len(rels_view_pbix) + 1) * 35 + 3))
+                elif search_term_sb: st.info(f"No PBIX relationships match '{st.session_state.explorer_search_term}'.")
+            else: st.info("No relationships found in PBIX.")
     # Report Structure
     elif st.session_state.explorer_option == "Report Structure":
-        st.sidebar.markdown("##### Report Structure (Pages & Visuals)")
+        st.markdown("##### Report Structure (Pages & Visuals)")
         report_pages_data = None; source_type_for_msg = ""
         if st.session_state.active_file_type == "pbit" and st.session_state.pbit_metadata: report_pages_data = st.session_state.pbit_metadata.get("report_pages", []); source_type_for_msg = "PBIT"
         elif st.session_state.active_file_type == "pbix" and st.session_state.pbix_report_layout: report_pages_data = st.session_state.pbix_report_layout; source_type_for_msg = "PBIX"
         if report_pages_data:
-            all_pages = sorted(report_pages_data, key=lambda x: x.get("name", "Unnamed Page"))
-            filtered_pages = [p for p in all_pages if not search_term_sb or search_term_sb in p.get("name","").lower() or any(search_term_sb in str(v.get("title","")).lower() or search_term_sb in str(v.get("type","")).lower() or any(search_term_sb in f.lower() for f in v.get("fields_used",[])) for v in p.get("visuals",[]))]
-            if filtered_pages:
-                for page in filtered_pages:
-                    page_name = page.get("name", "Unknown Page")
-                    with st.sidebar.expander(f"Page: **{page_name}** ({len(page.get('visuals',[]))} visuals)"):
-                        if page.get("visuals"):
-                            for visual in page["visuals"]:
-                                visual_title_or_type = visual.get('title') if visual.get('title') else visual.get('type', 'Unknown Visual'); st.markdown(f"**{visual_title_or_type}** (Type: {visual.get('type', 'N/A')})")
-                                fields = visual.get("fields_used", []);
-                                if fields: st.caption(f"Fields: {', '.join(f'`{f}`' for f in fields)}")
-                                else: st.caption("_No specific fields identified._")
+            page_positions = filter_positions(st.session_state.file_hash, "report_pages", search_term_sb, search_index_sb)
+            if page_positions:
+                for page_pos in page_positions[page_slice(len(page_positions), f"report_pages_page_{search_term_sb}")]:
+                    page_title, visuals_df = search_index_sb["report_page_panels"][page_pos] # Title and one-Arrow-payload visuals frame, prebuilt per file
+                    with st.expander(page_title):
+                        if visuals_df is not None:
+                            st.dataframe(visuals_df, use_container_width=True, hide_index=True, height=min(300, (len(visuals_df) + 1) * 35 + 3), column_config={"Fields": st.column_config.ListColumn("Fields", help="Fields used by the visual", width="large")})
                         else: st.write("No visuals found on this page.")
-            elif search_term_sb: st.sidebar.info(f"No report items match '{st.session_state.explorer_search_term}' in {source_type_for_msg}.")
-        elif st.session_state.active_file_type == "pbix" and not st.session_state.pbix_report_layout: st.sidebar.info("Report structure (Report/Layout) was not found or parsed from this PBIX file.")
-        else: st.sidebar.info(f"No report structure information found in {source_type_for_msg}.")
+            elif search_term_sb: st.info(f"No report items match '{st.session_state.explorer_search_term}' in {source_type_for_msg}.")
+        elif st.session_state.active_file_type == "pbix" and not st.session_state.pbix_report_layout: st.info("Report structure (Report/Layout) was not found or parsed from this PBIX file.")
+        else: st.info(f"No report structure information found in {source_type_for_msg}.")
     # Table Data
     elif st.session_state.explorer_option == "Table Data":
         if st.session_state.active_file_type == "pbix" and st.session_state.pbix_object:
-            st.sidebar.markdown("##### View Table Data (PBIX - First 100 Rows)")
-            pbix_obj_for_view = st.session_state.pbix_object; pbix_tables_for_view = sorted(list(pbix_obj_for_view.tables))
+            st.markdown(f"##### View Table Data (PBIX - First {TABLE_PREVIEW_ROWS} Rows)")
+            pbix_obj_for_view = st.session_state.pbix_object; pbix_tables_for_view = pbix_frames_sb["table_names"]
             if pbix_tables_for_view:
                 table_options = ["Select a table..."] + pbix_tables_for_view
-                selected_table_in_sb = st.sidebar.selectbox("Select table to view:", options=table_options, key="sidebar_pbix_table_select_viewer")
+                selected_table_in_sb = st.selectbox("Select table to view:", options=table_options, key="sidebar_pbix_table_select_viewer")
                 if selected_table_in_sb != "Select a table...":
                     try:
-                        with st.spinner(f"Loading first 100 rows of '{selected_table_in_sb}'..."):
-                            data_df_sb = pbix_obj_for_view.get_table(selected_table_in_sb).head(100)
-                            st.sidebar.caption(f"Displaying first {len(data_df_sb)} rows of **{selected_table_in_sb}**:")
-                            st.sidebar.dataframe(data_df_sb, height=300)
-                    except Exception as e_sb_table: st.sidebar.error(f"Could not load data for '{selected_table_in_sb}': {e_sb_table}")
-            else: st.sidebar.info("No tables found in PBIX to view.")
-        else: st.sidebar.info("This option is for PBIX files only.")
+                        with st.spinner(f"Loading first {TABLE_PREVIEW_ROWS} rows of '{selected_table_in_sb}'..."):
+                            data_df_sb, total_rows_sb = get_pbix_table_head(st.session_state.file_hash, selected_table_in_sb, TABLE_PREVIEW_ROWS, pbix_obj_for_view)
+                            st.caption(f"Displaying first {len(data_df_sb)} of {total_rows_sb:,} rows of **{selected_table_in_sb}**:")
+                            st.dataframe(data_df_sb, height=300)
+                        if total_rows_sb > len(data_df_sb) and st.toggle(f"Show all {total_rows_sb:,} rows", key=f"table_full_{selected_table_in_sb}"): # Full frame only decoded and sent on request
+                            with st.spinner(f"Loading all rows of '{selected_table_in_sb}'..."): st.dataframe(get_pbix_full_table(st.session_state.file_hash, selected_table_in_sb, pbix_obj_for_view), height=300) # Reruns with the toggle on reuse the decoded frame
+                    except Exception as e_sb_table: st.error(f"Could not load data for '{selected_table_in_sb}': {e_sb_table}")
+            else: st.info("No tables found in PBIX to view.")
+        else: st.info("This option is for PBIX files only.")
 
-# --- Main Page: Chatbot Interface ---
-st.header("📊 PBIXplorer Analysis Tool")
+if st.session_state.active_file_type:
+    with st.sidebar: render_metadata_explorer()
 
-if not st.session_state.active_file_type:
-    st.info("👈 Upload a .pbit or .pbix file and configure Gemini API Key in the sidebar to begin.")
-elif not st.session_state.gemini_configured:
-    st.info("👈 Please configure your Gemini API Key in the sidebar to enable PBIXplorer.")
-else:
-    display_filename = st.session_state.get("original_uploaded_file_name", "N/A")
-    file_type_display = st.session_state.active_file_type.upper() if st.session_state.active_file_type else ""
-    st.caption(f"Currently analyzing {file_type_display}: **{display_filename}** with PBIXplorer (Gemini).")
+# --- Chat turn processing (runs inside the chat fragment, no full-app reruns) ---
+def _partial_marker_start(text):
+    """Index of a trailing, possibly incomplete tool request start marker in text (len(text) if there is none)."""
+    slash_idx = text.rfind("//")
+    if slash_idx != -1 and "TOOL_REQUEST_START".startswith(text[slash_idx + 2:].lstrip()): return slash_idx
+    return len(text) - 1 if text.endswith("/") else len(text)
 
-    # RAG Re-prompt Logic
-    if st.session_state.pending_rag_reprompt_details:
-        details = st.session_state.pending_rag_reprompt_details
-        tables_to_fetch = details["table_names"]
-        original_user_query = details["original_user_query"]
-        
-        with st.spinner(f"PBIXplorer is analyzing additional data for table(s): {', '.join(tables_to_fetch)}..."):
-            fetched_data_strings = []
-            if st.session_state.pbix_object and tables_to_fetch:
-                for table_name in tables_to_fetch:
-                    try:
-                        fetched_df = st.session_state.pbix_object.get_table(table_name)
-                        df_sample_str = fetched_df.head(MAX_TOOL_FETCHED_ROWS_FOR_REPROMPT).to_string(index=False) # Using to_string for simplicity
-                        fetched_data_strings.append(f"--- Data from table: {table_name} ---\n{df_sample_str}\n")
-                    except Exception as e_fetch:
-                        fetched_data_strings.append(f"--- Error fetching data for table: {table_name} ---\n{e_fetch}\n")
-            
-            combined_fetched_data_str = "\n".join(fetched_data_strings) if fetched_data_strings else "No additional data could be fetched or was requested."
-            chat_history_for_reprompt = format_chat_history_for_prompt(st.session_state.chat_history, MAX_CHAT_HISTORY_TURNS)
-            
-            reprompt_for_gemini = construct_reprompt_with_fetched_data(
-                original_user_query, st.session_state.current_metadata_context_string,
-                chat_history_for_reprompt, tables_to_fetch, combined_fetched_data_str
-            )
-            final_response_text = generate_gemini_response(reprompt_for_gemini)
-            st.session_state.chat_history.append({"role": "assistant", "content": final_response_text})
-            st.session_state.pending_rag_reprompt_details = None
-            st.session_state.run_id +=1
-            st.rerun()
+def _stream_until_tool_request(chunks, collected):
+    """Yields streamed text up to any tool request block, collecting every chunk so the caller can parse the full reply."""
+    held = ""; hidden = False
+    for chunk in chunks:
+        collected.append(chunk)
+        if hidden: continue
+        held += chunk; marker_match = TOOL_REQUEST_START_RE.search(held)
+        if marker_match:
+            hidden = True
+            if held[:marker_match.start()]: yield held[:marker_match.start()]
+            continue
+        release_upto = _partial_marker_start(held) # Hold back a tail that could be the start of a split marker
+        if release_upto > 0: yield held[:release_upto]; held = held[release_upto:]
+    if not hidden and held: yield held
 
-    # Chat history display
-    chat_box_style = ("max-height: 600px; overflow-y: auto; padding: 10px; "
-                      "border-radius: 5px; margin-bottom: 10px;")
-    st.markdown(f'<div id="chat-messages-container" style="{chat_box_style}">', unsafe_allow_html=True)
-    for message in st.session_state.chat_history:
+def stream_gemini_response(full_prompt):
+    """Streams a Gemini reply into a temporary chat bubble and returns the full text; the caller appends and renders it from history."""
+    collected = []; stream_slot = st.empty()
+    with stream_slot.container(), st.chat_message("assistant"):
+        st.write_stream(_stream_until_tool_request(generate_gemini_response_stream(full_prompt, st.session_state.current_context_prelude), collected)) # The prelude lets Gemini serve the file context from its context cache
+    stream_slot.empty()
+    return "".join(collected)
+
+def fetched_table_block(file_hash, table_name, pbix_obj):
+    """Formats one table requested by PBIXplorer for the reprompt, or the error that prevented fetching it."""
+    try:
+        fetched_head, _ = get_pbix_table_head(file_hash, table_name, MAX_TOOL_FETCHED_ROWS_FOR_REPROMPT, pbix_obj) # Repeat requests for a table skip the decode
+        return f"--- Data from table: {table_name} ---\n{format_fetched_table_for_prompt(fetched_head)}\n"
+    except Exception as e_fetch:
+        return f"--- Error fetching data for table: {table_name} ---\n{e_fetch}\n"
+
+def process_rag_reprompt(generate_response=generate_gemini_response):
+    """Fetches the tables PBIXplorer asked for and re-prompts Gemini with them, appending the final answer."""
+    details = st.session_state.pending_rag_reprompt_details
+    tables_to_fetch = details["table_names"]
+    original_user_query = details["original_user_query"]
+
+    fetched_data_strings = []
+    if st.session_state.pbix_object and tables_to_fetch:
+        fetched_data_strings = [fetched_table_block(st.session_state.file_hash, table_name, st.session_state.pbix_object) for table_name in tables_to_fetch]
+
+    combined_fetched_data_str = "\n".join(fetched_data_strings) if fetched_data_strings else "No additional data could be fetched or was requested."
+    chat_history_for_reprompt = format_chat_history_for_prompt(st.session_state.chat_history, MAX_CHAT_HISTORY_TURNS)
+
+    reprompt_for_gemini = construct_reprompt_with_fetched_data(
+        original_user_query, st.session_state.current_context_prelude,
+        chat_history_for_reprompt, tables_to_fetch, combined_fetched_data_str
+    )
+    final_response_text = generate_response(reprompt_for_gemini)
+    st.session_state.chat_history.append({"role": "assistant", "content": final_response_text})
+    st.session_state.pending_rag_reprompt_details = None
+
+def process_user_query(user_query, generate_response=generate_gemini_response):
+    """Answers the latest user message, or queues a RAG re-prompt when PBIXplorer requests table data."""
+    if st.session_state.active_file_type and st.session_state.current_metadata_context_string:
+        chat_history_for_prompt = format_chat_history_for_prompt(st.session_state.chat_history[:-1], MAX_CHAT_HISTORY_TURNS)
+        initial_prompt_for_gemini = construct_initial_prompt(user_query, st.session_state.current_context_prelude, chat_history_for_prompt)
+        gemini_response_text = generate_response(initial_prompt_for_gemini)
+        tool_request_data = None; preliminary_message = ""
+
+        tool_request_match = TOOL_REQUEST_RE.search(gemini_response_text) # One C-level scan locates the envelope and its JSON payload
+        if tool_request_match:
+            try:
+                preliminary_message = gemini_response_text[:tool_request_match.start()].strip()
+                if preliminary_message: st.session_state.chat_history.append({"role": "assistant", "content": preliminary_message})
+                tool_request_data = json_loads(tool_request_match.group(1)) # orjson when installed; stdlib errors still surface as JSONDecodeError
+            except json.JSONDecodeError as e_json:
+                print(f"JSONDecodeError: {e_json}\nAttempted: '{tool_request_match.group(1)}'")
+                gemini_response_text = f"PBIXplorer internal data request format error. Details: {e_json}. Raw output: {gemini_response_text}"
+            except Exception as e_tool_parse:
+                print(f"Generic tool parse error: {e_tool_parse}"); gemini_response_text = f"PBIXplorer internal action issue. Raw: {gemini_response_text}"
+        elif TOOL_REQUEST_START_RE.search(gemini_response_text):
+            gemini_response_text = f"PBIXplorer internal format error. Raw: {gemini_response_text}" # Markers without a JSON object between them
+
+        if tool_request_data and tool_request_data.get("tool_name") == "fetch_tables_for_analysis":
+            params = tool_request_data.get("parameters", {})
+            tables_to_fetch = params.get("table_names", [])
+            if isinstance(tables_to_fetch, str): tables_to_fetch = [tables_to_fetch]
+            reason_for_user = params.get("reason_for_user", f"To proceed, I need more data from table(s): {', '.join(tables_to_fetch) if tables_to_fetch else 'requested tables'}.")
+            if tables_to_fetch:
+                st.session_state.pending_rag_reprompt_details = {"table_names": tables_to_fetch, "original_user_query": user_query, "reason_for_user": reason_for_user}
+                if not preliminary_message: st.session_state.chat_history.append({"role": "assistant", "content": reason_for_user})
+                st.session_state.chat_history.append({"role": "assistant", "content": f"*PBIXplorer is now fetching additional data for table(s): **{', '.join(tables_to_fetch)}**...*"})
+            else: st.session_state.chat_history.append({"role": "assistant", "content": "PBIXplorer wanted to fetch more data but didn't specify which tables. Please try rephrasing."})
+        else: # No valid tool request, or it's not for fetching tables
+            st.session_state.chat_history.append({"role": "assistant", "content": gemini_response_text})
+    else:
+        st.session_state.chat_history.append({"role": "assistant", "content": "File data not available or metadata context not prepared."})
+
+def render_chat_messages(messages):
+    for message in messages:
         with st.chat_message(message["role"]):
             st.markdown(message["content"]) # Ensure Gemini output is rendered as Markdown
-    st.markdown('</div>', unsafe_allow_html=True)
 
-    js_key = f"auto_scroll_js_{st.session_state.run_id}"
-    js_autoscroll = f"""<script name="{js_key}"> setTimeout(function() {{
-            var chatContainer = document.getElementById("chat-messages-container");
-            if (chatContainer) {{ chatContainer.scrollTop = chatContainer.scrollHeight; }}
-        }}, 150); </script>"""
-    if st.session_state.chat_history:
-        st.components.v1.html(js_autoscroll, height=0, scrolling=False)
+def render_settled_messages(messages):
+    """Renders settled chat turns as plain markdown (rule, role label, content) instead of a chat_message per turn.
+    Each turn gets its own element, so an unclosed code fence in one reply cannot swallow the turns after it."""
+    for i, message in enumerate(messages):
+        rule = "---\n\n" if i else ""
+        st.markdown(f'{rule}{CHAT_ROLE_LABELS.get(message["role"], message["role"])}\n\n{message["content"]}') # No unsafe_allow_html: prompts and replies must never be interpreted as HTML
+
+@st.fragment
+def render_chat():
+    """Renders the chat as a fragment: sending a message reruns only this block and replies are drawn in place."""
+    # Chat history display
+    messages_container = st.container(height=CHAT_BOX_HEIGHT) # Created before chat_input so replies generated below still render above it
+    with messages_container:
+        # Only the most recent messages are rendered by default; older ones are sent to the browser only on request
+        older_count = max(0, len(st.session_state.chat_history) - CHAT_RECENT_MESSAGES)
+        show_older = older_count > 0 and st.toggle(f"Show {older_count} older messages", key="chat_show_older")
+        shown_messages = st.session_state.chat_history[0 if show_older else older_count:]
+        settled_messages, live_messages = shown_messages[:-CHAT_LIVE_MESSAGES], shown_messages[-CHAT_LIVE_MESSAGES:]
+        render_settled_messages(settled_messages)
+        if settled_messages and live_messages: st.markdown("---")
+        render_chat_messages(live_messages)
 
     if not st.session_state.pending_rag_reprompt_details:
         if prompt := st.chat_input("Ask PBIXplorer about the file or data concepts..."):
             st.session_state.chat_history.append({"role": "user", "content": prompt})
-            st.session_state.run_id += 1
-            st.rerun()
+            with messages_container: render_chat_messages(st.session_state.chat_history[-1:])
 
+    rendered_count = len(st.session_state.chat_history)
     if st.session_state.chat_history and \
        st.session_state.chat_history[-1]["role"] == "user" and \
        not st.session_state.pending_rag_reprompt_details:
-        user_query = st.session_state.chat_history[-1]["content"]
-        with st.spinner("PBIXplorer is thinking..."):
-            if st.session_state.active_file_type and st.session_state.current_metadata_context_string:
-                chat_history_for_prompt = format_chat_history_for_prompt(st.session_state.chat_history[:-1], MAX_CHAT_HISTORY_TURNS)
-                initial_prompt_for_gemini = construct_initial_prompt(user_query, st.session_state.current_metadata_context_string, chat_history_for_prompt)
-                gemini_response_text = generate_gemini_response(initial_prompt_for_gemini)
-                tool_request_data = None
-
-                if "// TOOL_REQUEST_START" in gemini_response_text and "// TOOL_REQUEST_END" in gemini_response_text:
-                    try:
-                        block_start_marker = "// TOOL_REQUEST_START"; block_end_marker = "// TOOL_REQUEST_END"
-                        start_of_block_idx = gemini_response_text.find(block_start_marker)
-                        content_start_idx = start_of_block_idx + len(block_start_marker)
-                        content_end_idx = gemini_response_text.find(block_end_marker, content_start_idx)
-                        preliminary_message = gemini_response_text[:start_of_block_idx].strip()
-                        if preliminary_message: st.session_state.chat_history.append({"role": "assistant", "content": preliminary_message})
-
-                        if content_end_idx != -1:
-                            json_candidate_str = gemini_response_text[content_start_idx:content_end_idx].strip()
-                            first_brace = json_candidate_str.find('{'); last_brace = json_candidate_str.rfind('}')
-                            if first_brace != -1 and last_brace != -1 and last_brace > first_brace:
-                                actual_json_str = json_candidate_str[first_brace : last_brace+1]
-                                tool_request_data = json.loads(actual_json_str)
-                            else: gemini_response_text = f"PBIXplorer internal format error. Raw: {json_candidate_str}"
-                        else: gemini_response_text = f"PBIXplorer formatting error. Raw: {gemini_response_text}"
-                    except json.JSONDecodeError as e_json:
-                        print(f"JSONDecodeError: {e_json}\nAttempted: '{actual_json_str if 'actual_json_str' in locals() else json_candidate_str if 'json_candidate_str' in locals() else 'unknown'}'")
-                        gemini_response_text = f"PBIXplorer internal data request format error. Details: {e_json}. Raw output: {gemini_response_text}"
-                    except Exception as e_tool_parse:
-                        print(f"Generic tool parse error: {e_tool_parse}"); gemini_response_text = f"PBIXplorer internal action issue. Raw: {gemini_response_text}"
-                
-                if tool_request_data and tool_request_data.get("tool_name") == "fetch_tables_for_analysis":
-                    params = tool_request_data.get("parameters", {})
-                    tables_to_fetch = params.get("table_names", [])
-                    if isinstance(tables_to_fetch, str): tables_to_fetch = [tables_to_fetch]
-                    reason_for_user = params.get("reason_for_user", f"To proceed, I need more data from table(s): {', '.join(tables_to_fetch) if tables_to_fetch else 'requested tables'}.")
-                    if tables_to_fetch:
-                        st.session_state.pending_rag_reprompt_details = {"table_names": tables_to_fetch, "original_user_query": user_query, "reason_for_user": reason_for_user}
-                        if not ('preliminary_message' in locals() and preliminary_message): st.session_state.chat_history.append({"role": "assistant", "content": reason_for_user})
-                        st.session_state.chat_history.append({"role": "assistant", "content": f"*PBIXplorer is now fetching additional data for table(s): **{', '.join(tables_to_fetch)}**...*"})
-                    else: st.session_state.chat_history.append({"role": "assistant", "content": "PBIXplorer wanted to fetch more data but didn't specify which tables. Please try rephrasing."})
-                else: # No valid tool request, or it's not for fetching tables
-                    st.session_state.chat_history.append({"role": "assistant", "content": gemini_response_text})
-            else:
-                st.session_state.chat_history.append({"role": "assistant", "content": "File data not available or metadata context not prepared."})
-            st.session_state.run_id += 1
-            st.rerun()
+        with messages_container, st.spinner("PBIXplorer is thinking..."):
+            process_user_query(st.session_state.chat_history[-1]["content"], generate_response=stream_gemini_response)
+        with messages_container: render_chat_messages(st.session_state.chat_history[rendered_count:])
+        rendered_count = len(st.session_state.chat_history)
+
+    # RAG Re-prompt Logic
+    if st.session_state.pending_rag_reprompt_details:
+        tables_to_fetch = st.session_state.pending_rag_reprompt_details["table_names"]
+        with messages_container, st.spinner(f"PBIXplorer is analyzing additional data for table(s): {', '.join(tables_to_fetch)}..."):
+            process_rag_reprompt(generate_response=stream_gemini_response)
+        with messages_container: render_chat_messages(st.session_state.chat_history[rendered_count:])
+
+    # Identical markup every run, so Streamlit keeps the same iframe instead of loading a new one per chat turn
+    if st.session_state.chat_history:
+        st.components.v1.html(CHAT_AUTOSCROLL_JS, height=0, scrolling=False)
+
+# --- Main Page: Chatbot Interface ---
+st.header("📊 PBIXplorer Analysis Tool")
+
+if not st.session_state.active_file_type:
+    st.info("👈 Upload a .pbit or .pbix file and configure Gemini API Key in the sidebar to begin.")
+elif not st.session_state.gemini_configured:
+    st.info("👈 Please configure your Gemini API Key in the sidebar to enable PBIXplorer.")
+else:
+    display_filename = st.session_state.get("original_uploaded_file_name", "N/A")
+    file_type_display = st.session_state.active_file_type.upper() if st.session_state.active_file_type else ""
+    st.caption(f"Currently analyzing {file_type_display}: **{display_filename}** with PBIXplorer (Gemini).")
+    render_chat()
 
 st.sidebar.markdown("---")
-st.sidebar.caption("**PBIXplorer Analysis Tool**  \nDeveloped by Marvin Heng  \n*Powered by Gemini*")
\ No newline at end of file
+st.sidebar.caption("**PBIXplorer Analysis Tool**  \nDeveloped by Marvin Heng  \n*Powered by Gemini*")
@@ -0,0 +1,249 @@
+import streamlit as st
+import copy
+import hashlib
+import zipfile
+from bisect import bisect_right
+from typing import BinaryIO
+import pandas as pd
+from pbit_parser import parse_pbit_file, extract_report_layout_from_zip
+from chatbot_logic import format_metadata_for_gemini
+try: import xxhash # Optional: SIMD-accelerated xxh3 hashes large uploads several times faster than blake2b
+except ImportError: xxhash = None
+
+# Helpers shared by the Streamlit entry point. Living in an imported module, they are defined once per
+# process instead of on every script rerun, and their st.cache_* entries sit in a single cache namespace.
+
+# --- Session State Initialization ---
+SESSION_DEFAULTS = {
+    "gemini_api_key": "", "gemini_configured": False,
+    "pbit_metadata": None, "pbix_object": None, "pbix_report_layout": None, "active_file_type": None,
+    "chat_history": [],
+    "uploaded_file_widget": None, # Key for file_uploader widget
+    "uploader_generation": 0, # Bumped to swap in a fresh (empty) file_uploader when the loaded file is cleared
+    "original_uploaded_file_name": None,
+    "explorer_search_term": "", "explorer_option": "Select an option...",
+    "sidebar_pbix_table_select_viewer": "Select a table...",
+    "current_metadata_context_string": "", "current_context_prelude": "", "pending_rag_reprompt_details": None,
+    "explorer_search_index": None, "pbix_frames": None, "file_hash": None,
+}
+
+def init_session_state():
+    """Seeds every session_state key the app reads, leaving existing values untouched."""
+    for key, default in SESSION_DEFAULTS.items():
+        st.session_state.setdefault(key, copy.copy(default)) # Copy so sessions never share the mutable defaults
+
+# Everything derived from the loaded file; reset together when the upload changes or is cleared
+FILE_STATE_KEYS = (
+    "pbit_metadata", "pbix_object", "pbix_report_layout", "active_file_type", "original_uploaded_file_name",
+    "current_metadata_context_string", "current_context_prelude", "pending_rag_reprompt_details", "chat_history",
+    "explorer_option", "explorer_search_term", "sidebar_pbix_table_select_viewer", "explorer_search_index", "pbix_frames", "file_hash",
+)
+
+def reset_file_state():
+    """Returns every per-file session_state key to its SESSION_DEFAULTS value."""
+    for key in FILE_STATE_KEYS: st.session_state[key] = copy.copy(SESSION_DEFAULTS[key])
+
+def clear_loaded_file():
+    """
+    Resets this session's view of the loaded file (explorer, chat, derived frames) and empties the uploader.
+    The parsed file itself stays in the shared get_pbix_file/get_pbit_metadata caches until their LRU evicts it.
+    """
+    reset_file_state(); st.session_state.uploader_generation += 1
+
+# --- Lowercase search index (built once per loaded file) ---
+def _haystack(*parts):
+    """Joins the searchable fields of one explorer item into a single lowercase string."""
+    return "\x1f".join(str(p) for p in parts).lower()
+
+def _lower_view(items_dict):
+    """Lowercases a {name: formula} dict once; non-string formulas only ever match on name."""
+    return {k: (str(k).lower(), v.lower() if isinstance(v, str) else "") for k, v in items_dict.items()}
+
+def _category_blob(entries):
+    """Concatenates a category's haystacks into one string plus each item's start offset, for a single find() scan."""
+    starts, offset = [], 0
+    for _, haystack in entries: starts.append(offset); offset += len(haystack) + 1
+    return "\x1e".join(haystack for _, haystack in entries), starts
+
+def _scan_blob(blob, starts, search_term):
+    """Returns the positions of items whose haystack contains search_term, jumping to the next item after each hit."""
+    positions = []; pos = blob.find(search_term)
+    while pos != -1:
+        i = bisect_right(starts, pos) - 1; positions.append(i)
+        if i + 1 >= len(starts): break
+        pos = blob.find(search_term, starts[i + 1])
+    return positions
+
+def _report_page_panel(page):
+    """Returns the expander title and visuals frame (None for an empty page) of one report page, built once per file."""
+    visuals = page.get("visuals") or []
+    page_title = f"Page: **{page.get('name', 'Unknown Page')}** ({len(visuals)} visuals)"
+    if not visuals: return page_title, None
+    return page_title, pd.DataFrame({"Visual": [v.get("title") or v.get("type", "Unknown Visual") for v in visuals], "Type": [v.get("type", "N/A") for v in visuals], "Fields": [v.get("fields_used", []) for v in visuals]})
+
+def build_search_index(metadata):
+    """
+    Returns {category: [(item, haystack), ...]} in display order so explorer filters are one substring test per item.
+    Measures and calculated columns are dicts, so they get a {name: (name_lower, formula_lower)} view instead.
+    "report_page_panels" holds each page's ready-to-render (title, visuals frame), aligned with "report_pages".
+    "blobs" holds each list category joined into one string so a search is one C-level scan rather than a Python loop.
+    For PBIX only the report layout is indexed here ({"report_pages": ...}); its data model lives in DataFrames.
+    """
+    pages = sorted(metadata.get("report_pages", []), key=lambda x: x.get("name") or "Unnamed Page") # tables/m_queries arrive pre-sorted from parse_pbit_file
+    index = {
+        "tables": [(t, _haystack(t.get("name", ""), *[f for col in t.get("columns", []) for f in (col.get("name", ""), col.get("dataType", ""))])) for t in metadata.get("tables", [])],
+        "relationships": [(r, _haystack(r.get("fromTable", ""), r.get("toTable", ""), r.get("fromColumn", ""), r.get("toColumn", ""))) for r in metadata.get("relationships", [])],
+        "m_queries": [(mq, _haystack(mq.get("table_name", ""), mq.get("script", ""), *mq.get("analysis", {}).get("sources", []), *mq.get("analysis", {}).get("transformations", []))) for mq in metadata.get("m_queries", [])],
+        "measures": _lower_view(metadata.get("measures", {})),
+        "calculated_columns": _lower_view(metadata.get("calculated_columns", {})),
+        "report_pages": [(p, _haystack(p.get("name", ""), *[f for v in p.get("visuals", []) for f in (v.get("title", ""), v.get("type", ""), *v.get("fields_used", []))])) for p in pages],
+    }
+    index["report_page_panels"] = [_report_page_panel(p) for p, _ in index["report_pages"]]
+    index["blobs"] = {category: _category_blob(index[category]) for category in ("tables", "relationships", "m_queries", "report_pages")}
+    return index
+
+# Display order of the PBIX explorer frames; sorted once at load so boolean-mask filtering keeps it for free
+PBIX_SORT_KEYS = {"dax_measures": ["TableName", "Name"], "dax_columns": ["TableName", "ColumnName"], "power_query": ["TableName"]}
+
+def _sorted_frame(category, frame):
+    """Returns a PBIX metadata frame in explorer display order with a fresh positional index."""
+    return frame if frame is None or frame.empty else frame.sort_values(by=PBIX_SORT_KEYS[category]).reset_index(drop=True)
+
+def snapshot_pbix_frames(pbix_obj):
+    """
+    Reads the PBIXRay frames the explorer uses once per file; schema and tables rebuild a DataFrame/array on every property access.
+    "columns_by_table" holds each table's display-ready column frame from one groupby pass, so no per-table boolean scan of the schema.
+    "search_blobs" (one lowercase Series per frame) and "table_blobs" fuse each item's searched fields once, for single-pass filters.
+    """
+    schema = pbix_obj.schema
+    columns_view = schema[["TableName", "ColumnName", "PandasDataType"]].rename(columns={"ColumnName": "Column Name", "PandasDataType": "Data Type"})
+    frames = {
+        "schema": schema, "table_names": sorted(pbix_obj.tables),
+        "columns_by_table": {name: group.drop(columns="TableName").reset_index(drop=True) for name, group in columns_view.groupby("TableName", sort=False)},
+        **{category: _sorted_frame(category, getattr(pbix_obj, category)) for category in ("dax_measures", "dax_columns", "power_query")},
+        "relationships": pbix_obj.relationships,
+    }
+    frames["search_blobs"] = {category: _search_blob(*_pbix_search_columns(category, frames[category])) for category in ("dax_measures", "dax_columns", "power_query", "relationships") if frames[category] is not None and not frames[category].empty}
+    frames["table_blobs"] = {name: "\x1f".join([name, *cols["Column Name"].astype(str), *cols["Data Type"].astype(str)]).lower() for name, cols in frames["columns_by_table"].items()}
+    return frames
+
+# --- Memoized explorer filters (keyed on file_hash, category and lowercase term; the index itself is not hashed) ---
+@st.cache_data(show_spinner=False, max_entries=256)
+def search_index_matches(file_hash, category, search_term, _search_index):
+    """
+    Scans one index category for a lowercase term, once per (file, category, term), so retyping or revisiting a search is a lookup.
+    Returns positions into the (item, haystack) list categories, or matching names for measures/calculated columns.
+    """
+    entries = _search_index[category]
+    if isinstance(entries, dict): return [k for k, (k_lower, v_lower) in entries.items() if search_term in k_lower or search_term in v_lower]
+    if "\x1e" in search_term: return [i for i, (_, haystack) in enumerate(entries) if search_term in haystack] # Would straddle items in the blob
+    return _scan_blob(*_search_index["blobs"][category], search_term)
+
+def filter_positions(file_hash, category, search_term, search_index):
+    """Returns the positions of a list category's items matching the lowercase search_term, in display order."""
+    if not search_term: return range(len(search_index[category]))
+    return search_index_matches(file_hash, category, search_term, search_index)
+
+def filter_index(file_hash, category, search_term, search_index):
+    """Returns the items of a list category matching the lowercase search_term, in display order."""
+    entries = search_index[category]
+    return [entries[i][0] for i in filter_positions(file_hash, category, search_term, search_index)]
+
+def _pbix_search_columns(category, frame):
+    """The Series a PBIX explorer frame is searched on; qualified Table.Name strings are matched as one value."""
+    if category == "dax_measures": return (frame["TableName"].astype(str) + "." + frame["Name"].astype(str), frame["Expression"], frame["DisplayFolder"])
+    if category == "dax_columns": return (frame["TableName"].astype(str) + "." + frame["ColumnName"].astype(str), frame["Expression"])
+    if category == "power_query": return (frame["TableName"], frame["Expression"])
+    return tuple(frame[col] for col in ("FromTableName", "FromColumnName", "ToTableName", "ToColumnName")) # relationships
+
+def _search_blob(*columns):
+    """Fuses a frame's searched Series into one lowercase string per row, so a search is a single str.contains pass."""
+    blob = columns[0].fillna("").astype(str) # Missing values become "" so one empty cell cannot null out the whole row's blob
+    for col in columns[1:]: blob = blob + "\x1f" + col.fillna("").astype(str)
+    return blob.str.lower()
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def filter_pbix_frame(file_hash, category, search_term, _pbix_frames):
+    """Returns the rows of a (pre-sorted) PBIX explorer frame matching the lowercase search_term, once per (file, category, term)."""
+    return _pbix_frames[category][_pbix_frames["search_blobs"][category].str.contains(search_term, regex=False).to_numpy()]
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def filter_pbix_table_names(file_hash, search_term, _pbix_frames):
+    """Returns the sorted PBIX table names whose name, column names or column data types contain the lowercase search_term."""
+    table_blobs = _pbix_frames["table_blobs"]
+    return [name for name in _pbix_frames["table_names"] if search_term in table_blobs.get(name, name.lower())]
+
+# --- Helper function for filtering dictionary items ---
+def filter_dict_items(items_dict, search_term, file_hash, category, search_index):
+    """Filters {name: formula} for measures/calculated columns through the memoized lowercase view in the search index."""
+    if not search_term: return items_dict
+    return {k: items_dict[k] for k in search_index_matches(file_hash, category, search_term.lower(), search_index)}
+
+# --- Cached explorer DataFrames (keyed on the upload's file_hash; underscore args are not hashed) ---
+# Explicit dtypes: low-cardinality columns go to the browser as Arrow dictionaries instead of repeated strings
+RELATIONSHIPS_DF_DTYPES = {"From": "string", "To": "string", "Active": "bool", "Filter Dir.": "category"}
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def build_relationships_df(file_hash, _relationships):
+    """Builds the PBIT relationships display frame from parallel column lists (pandas' cheapest constructor)."""
+    return pd.DataFrame({
+        "From": [f"{r.get('fromTable','?')}.{r.get('fromColumn','?')}" for r in _relationships],
+        "To": [f"{r.get('toTable','?')}.{r.get('toColumn','?')}" for r in _relationships],
+        "Active": [r.get("isActive", True) for r in _relationships],
+        "Filter Dir.": [r.get("crossFilteringBehavior", "N/A") for r in _relationships],
+    }).astype(RELATIONSHIPS_DF_DTYPES)
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def build_columns_df(file_hash, table_name, _columns):
+    """Builds one PBIT table's column list frame from parallel column lists."""
+    return pd.DataFrame({"Column Name": [col.get("name") for col in _columns], "Data Type": [col.get("dataType") for col in _columns]}).astype({"Column Name": "string", "Data Type": "category"})
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def get_pbix_table_head(file_hash, table_name, rows, _pbix_obj):
+    """
+    Decodes one PBIX table once per (file_hash, table_name, rows) and returns (first rows, total row count).
+    Only the head is cached, so the full decoded frame is freed right away.
+    """
+    table_df = _pbix_obj.get_table(table_name)
+    return table_df.head(rows), len(table_df)
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def get_pbix_full_table(file_hash, table_name, _pbix_obj):
+    """
+    Decodes one full PBIX table for "Show all rows", once per (file_hash, table_name); only the two most recent are kept.
+    cache_resource returns the frame itself rather than an unpickled copy, so callers must treat it as read-only.
+    """
+    return _pbix_obj.get_table(table_name)
+
+# --- Cached file parsing ---
+def file_digest(buffer) -> str:
+    """Content key for every per-file cache: xxh3-128 when xxhash is installed, blake2b-128 otherwise."""
+    if xxhash is not None: return xxhash.xxh3_128_hexdigest(buffer)
+    return hashlib.blake2b(buffer, digest_size=16).hexdigest()
+
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def get_pbit_metadata(file_hash: str, file_name: str, _source: BinaryIO):
+    """
+    Parses an in-memory .pbit stream (e.g. the UploadedFile itself), once per (file_hash, file_name).
+    cache_resource hands back the same dict without copying or deep-hashing it, so callers must treat it as read-only.
+    """
+    return parse_pbit_file(_source, file_name)
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def get_pbix_file(file_hash: str, _source: BinaryIO):
+    """
+    Opens a .pbix zip once and reads both the DataModel (PBIXRay) and Report/Layout from that handle, once per file_hash.
+    Returns (pbix_obj, report_pages); report_pages is None if the layout failed to parse. Both are shared, so treat them as read-only.
+    """
+    from pbixray_lib.core import PBIXRay # Imported lazily: PBIXRay pulls in xpress9/apsw, which .pbit-only use never needs
+    with zipfile.ZipFile(_source, 'r') as pbix_zip:
+        pbix_obj = PBIXRay(pbix_zip) # PbixUnpacker reads DataModel from the open handle without closing it
+        try: report_pages = extract_report_layout_from_zip(pbix_zip) # Inline, like the RAG fetch: both steps hold the GIL, so a worker thread cannot overlap them
+        except Exception: report_pages = None
+    return pbix_obj, report_pages
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def get_metadata_context(file_hash: str, file_type: str, file_name: str, _metadata, _report_layout=None) -> str:
+    """Gemini context string for a loaded file, built once per (file_hash, file_type, file_name): re-uploads skip the table sampling."""
+    return format_metadata_for_gemini(_metadata, file_type, file_name, _report_layout)
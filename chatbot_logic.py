@@ -1,28 +1,130 @@
-import google.generativeai as genai
 import pandas as pd
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Iterator
 import json
+import hashlib
+import threading
+import datetime
+import random
+import time
+from collections import OrderedDict
 
 # --- Gemini Model Holder ---
 gemini_model = None
+_configured_api_key = None # Key gemini_model was built with; genai.configure is process-wide, so one model serves every session
 MAX_SAMPLE_ROWS_PER_TABLE_IN_PROMPT = 10
 MAX_TOTAL_SAMPLE_CHARS_IN_PROMPT = 12000 # Max chars for ALL table samples combined
 MAX_TOOL_FETCHED_ROWS_FOR_REPROMPT = 200 # Max rows per table in a re-prompt
+MAX_TOOL_FETCHED_CELL_CHARS = 200 # Longer text cells in fetched rows are cut to this many chars
 MAX_CHAT_HISTORY_TURNS = 3 # Number of user/assistant turn pairs in history
+RESPONSE_CACHE_MAX_ENTRIES = 128 # Process-wide LRU of Gemini replies keyed on the full prompt
+GEMINI_MODEL_NAME = 'gemini-2.5-flash-preview-05-20'
+CONTEXT_CACHE_TTL = datetime.timedelta(hours=1) # Lifetime of a server-side CachedContent holding one file's context prelude
+CONTEXT_CACHE_MAX_ENTRIES = 8
+RATE_LIMIT_MAX_RETRIES = 3 # Retries of a Gemini call rejected with 429 / ResourceExhausted
+RATE_LIMIT_BACKOFF_SECONDS = 2.0 # First backoff; doubled per retry with +/-25% jitter
+
+# --- Response Cache ---
+# The prompt embeds the file context, recent history and the question, so an identical prompt can reuse the earlier reply
+_response_cache: "OrderedDict[str, str]" = OrderedDict()
+_response_cache_lock = threading.Lock() # Streamlit serves every session from its own thread
+
+def _prompt_cache_key(full_prompt: str) -> str:
+    return hashlib.blake2b(full_prompt.encode("utf-8"), digest_size=16).hexdigest() # Keeps large prompts out of the cache
+
+def _cached_response(cache_key: str) -> Optional[str]:
+    with _response_cache_lock:
+        response_text = _response_cache.get(cache_key)
+        if response_text is not None: _response_cache.move_to_end(cache_key)
+        return response_text
+
+def _remember_response(cache_key: str, response_text: str):
+    if not response_text or response_text.startswith("Error"): return # Never pin failures or blocked replies
+    with _response_cache_lock:
+        _response_cache[cache_key] = response_text; _response_cache.move_to_end(cache_key)
+        while len(_response_cache) > RESPONSE_CACHE_MAX_ENTRIES: _response_cache.popitem(last=False)
+
+def _finished_with_stop(response) -> bool:
+    """True when Gemini ended the reply itself; text cut off by SAFETY, MAX_TOKENS or RECITATION must not be cached."""
+    try: return response.candidates[0].finish_reason.name == "STOP"
+    except (AttributeError, IndexError): return False
+
+# --- Context Cache ---
+# The instructions + file metadata prelude is identical on every turn for a file, so it is uploaded once as a Gemini
+# CachedContent and later turns send only the history and question. Entries are (CachedContent, model); (None, None)
+# marks a prelude that could not be cached. Evicted contents are deleted so they stop being billed before their TTL.
+_context_cache_models: "OrderedDict[str, Any]" = OrderedDict()
+_context_cache_lock = threading.Lock()
+
+def _delete_cached_contents(entries):
+    """Deletes the server-side CachedContents of evicted entries; failures (e.g. already expired) are ignored."""
+    for cached_content, _ in entries:
+        if cached_content is None: continue
+        try: cached_content.delete()
+        except Exception as e: print(f"Could not delete cached context {getattr(cached_content, 'name', '?')}: {e}")
+
+def _context_cached_model(context_prelude: str):
+    """Returns a model bound to a CachedContent of context_prelude (created once per prelude), or None to send the prelude inline."""
+    cache_key = _prompt_cache_key(context_prelude)
+    with _context_cache_lock:
+        if cache_key in _context_cache_models:
+            _context_cache_models.move_to_end(cache_key); return _context_cache_models[cache_key][1]
+    try: # Created outside the lock: other sessions' Gemini calls must not wait on this network round trip
+        import google.generativeai as genai
+        cached_content = genai.caching.CachedContent.create(model=f"models/{GEMINI_MODEL_NAME}", contents=[context_prelude], ttl=CONTEXT_CACHE_TTL)
+        cached_model = genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+    except Exception as e: # e.g. a prelude below the model's minimum cacheable token count
+        print(f"Context caching unavailable, sending the context inline: {e}"); cached_content = cached_model = None
+    with _context_cache_lock:
+        if cache_key in _context_cache_models: # Another session cached this prelude meanwhile; keep the first entry
+            _context_cache_models.move_to_end(cache_key); evicted = [(cached_content, cached_model)]; cached_model = _context_cache_models[cache_key][1]
+        else:
+            _context_cache_models[cache_key] = (cached_content, cached_model); evicted = []
+            while len(_context_cache_models) > CONTEXT_CACHE_MAX_ENTRIES: evicted.append(_context_cache_models.popitem(last=False)[1])
+    _delete_cached_contents(evicted) # Network calls, so outside the lock
+    return cached_model
+
+def _call_with_backoff(model, prompt: str, stream: bool):
+    """Calls model.generate_content, retrying rate-limited (429) calls with jittered exponential backoff."""
+    from google.api_core import exceptions as google_exceptions # Ships with google-generativeai
+    for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+        try: return model.generate_content(prompt, stream=stream) # stream=True fetches the first chunk here, so a 429 surfaces before streaming
+        except google_exceptions.ResourceExhausted as e:
+            if attempt == RATE_LIMIT_MAX_RETRIES: raise
+            delay = RATE_LIMIT_BACKOFF_SECONDS * 2 ** attempt * random.uniform(0.75, 1.25)
+            print(f"Gemini rate limit hit, retrying in {delay:.1f}s: {e}"); time.sleep(delay)
+
+def _generate_content(full_prompt: str, context_prelude: Optional[str], stream: bool = False):
+    """Calls Gemini with the prelude served from the context cache when possible, falling back to the inline prompt."""
+    cached_model = _context_cached_model(context_prelude) if context_prelude and full_prompt.startswith(context_prelude) else None
+    if cached_model is not None:
+        from google.api_core import exceptions as google_exceptions
+        try: return _call_with_backoff(cached_model, full_prompt[len(context_prelude):], stream)
+        except google_exceptions.ResourceExhausted: raise # Still rate limited after the retries: the inline prompt would be too
+        except Exception as e: # e.g. the CachedContent expired; forget it so the next turn recreates it
+            print(f"Cached-context call failed, retrying inline: {e}")
+            with _context_cache_lock: stale_entry = _context_cache_models.pop(_prompt_cache_key(context_prelude), None)
+            if stale_entry is not None: _delete_cached_contents([stale_entry])
+    return _call_with_backoff(gemini_model, full_prompt, stream)
 
 def configure_gemini_model(api_key: str):
     """Configures and returns the Gemini Pro model."""
-    global gemini_model
+    global gemini_model, _configured_api_key
+    if gemini_model is not None and api_key == _configured_api_key: return True # Same key: keep the warm client and its connection
     try:
+        import google.generativeai as genai # Imported on first configure: the SDK (grpc/protobuf) is the slowest import at app start-up
+        with _context_cache_lock: # CachedContent belongs to the previous key's project: delete it while that key is still configured
+            previous_entries = list(_context_cache_models.values()); _context_cache_models.clear()
+        _delete_cached_contents(previous_entries)
+        with _response_cache_lock: _response_cache.clear() # Replies cached under the previous key are not replayed for a new one
         genai.configure(api_key=api_key)
         # Using gemini-2.5-flash-preview-05-20 for a balance of capability and speed/cost
-        model = genai.GenerativeModel('gemini-2.5-flash-preview-05-20')
-        gemini_model = model
-        print("Gemini model configured successfully with 'gemini-2.5-flash-preview-05-20'.")
+        model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+        gemini_model = model; _configured_api_key = api_key
+        print(f"Gemini model configured successfully with '{GEMINI_MODEL_NAME}'.")
         return True
     except Exception as e:
         print(f"Error configuring Gemini model: {e}")
-        gemini_model = None
+        gemini_model = None; _configured_api_key = None
         return False
 
 def _format_table_sample_for_gemini(df_sample: pd.DataFrame, table_name: str) -> str:
@@ -41,6 +143,14 @@ def _format_table_sample_for_gemini(df_sample: pd.DataFrame, table_name: str) ->
     except Exception:
         return f"  (Error formatting sample data for table '{table_name}')\n"
 
+def format_fetched_table_for_prompt(df: pd.DataFrame) -> str:
+    """Serializes fetched table rows as CSV: far fewer characters (and tokens) than the padded to_string layout."""
+    df = df.head(MAX_TOOL_FETCHED_ROWS_FOR_REPROMPT)
+    text_cols = df.select_dtypes(include=["object", "string"]).columns
+    if len(text_cols):
+        df = df.assign(**{col: df[col].where(df[col].isna(), df[col].astype(str).str.slice(0, MAX_TOOL_FETCHED_CELL_CHARS)) for col in text_cols}) # Missing cells stay empty CSV fields
+    return df.to_csv(index=False, lineterminator="\n")
+
 def _format_tables_schema_for_gemini(metadata_source: Any, file_type: str, pbix_object_for_samples: Optional[Any]) -> str:
     context_parts = []
     total_sample_chars_added = 0
@@ -69,8 +179,8 @@ def _format_tables_schema_for_gemini(metadata_source: Any, file_type: str, pbix_
                 table_cols_df = schema_df[schema_df['TableName'] == table_name]
                 if not table_cols_df.empty:
                     context_parts.append("Columns:")
-                    for _, row in table_cols_df.iterrows():
-                        context_parts.append(f"  - {row['ColumnName']} (DataType: {row['PandasDataType']})")
+                    for row in table_cols_df.itertuples(index=False):
+                        context_parts.append(f"  - {row.ColumnName} (DataType: {row.PandasDataType})")
                 else:
                     context_parts.append("  (No columns listed in schema DataFrame)")
 
@@ -104,10 +214,10 @@ def _format_dax_constructs_for_gemini(metadata_source: Any, file_type: str) -> s
         measures_df = metadata_source.dax_measures
         if measures_df is not None and not measures_df.empty:
             context_parts.append("=== DAX Measures ===")
-            for _, row in measures_df.iterrows():
-                desc = f" (Description: {row['Description']})" if pd.notna(row['Description']) and row['Description'] else ""
-                folder = f" (Display Folder: {row['DisplayFolder']})" if pd.notna(row['DisplayFolder']) and row['DisplayFolder'] else ""
-                context_parts.append(f"- `{row['TableName']}.{row['Name']}`{desc}{folder} := ```dax\n{row['Expression']}\n```")
+            for row in measures_df.itertuples(index=False):
+                desc = f" (Description: {row.Description})" if pd.notna(row.Description) and row.Description else ""
+                folder = f" (Display Folder: {row.DisplayFolder})" if pd.notna(row.DisplayFolder) and row.DisplayFolder else ""
+                context_parts.append(f"- `{row.TableName}.{row.Name}`{desc}{folder} := ```dax\n{row.Expression}\n```")
             context_parts.append("\n")
     # Calculated Columns
     if file_type == "pbit" and isinstance(metadata_source, dict):
@@ -120,7 +230,7 @@ def _format_dax_constructs_for_gemini(metadata_source: Any, file_type: str) -> s
         ccs_df = metadata_source.dax_columns
         if ccs_df is not None and not ccs_df.empty:
             context_parts.append("=== DAX Calculated Columns ===")
-            for _, row in ccs_df.iterrows(): context_parts.append(f"- `{row['TableName']}.{row['ColumnName']}` := ```dax\n{row['Expression']}\n```")
+            for row in ccs_df.itertuples(index=False): context_parts.append(f"- `{row.TableName}.{row.ColumnName}` := ```dax\n{row.Expression}\n```")
             context_parts.append("\n")
     return "\n".join(context_parts)
 
@@ -136,7 +246,7 @@ def _format_relationships_for_gemini(metadata_source: Any, file_type: str) -> st
         rels_df = metadata_source.relationships
         if rels_df is not None and not rels_df.empty:
             context_parts.append("=== Relationships ===")
-            for _, row in rels_df.iterrows(): context_parts.append(f"- From `{row['FromTableName']}.{row['FromColumnName']}` To `{row['ToTableName']}.{row['ToColumnName']}` (Active: {row['IsActive']}, Card: {row['Cardinality']}, Filter: {row['CrossFilteringBehavior']})")
+            for row in rels_df.itertuples(index=False): context_parts.append(f"- From `{row.FromTableName}.{row.FromColumnName}` To `{row.ToTableName}.{row.ToColumnName}` (Active: {row.IsActive}, Card: {row.Cardinality}, Filter: {row.CrossFilteringBehavior})")
             context_parts.append("\n")
     return "\n".join(context_parts)
 
@@ -157,9 +267,9 @@ def _format_m_queries_for_gemini(metadata_source: Any, file_type: str) -> str:
         pq_df = metadata_source.power_query
         if pq_df is not None and not pq_df.empty:
             context_parts.append("=== M Queries (Power Query) ===")
-            for _, row in pq_df.iterrows():
-                context_parts.append(f"-- Table: {row['TableName']} --")
-                context_parts.append(f"Script:\n```m\n{row['Expression']}\n```")
+            for row in pq_df.itertuples(index=False):
+                context_parts.append(f"-- Table: {row.TableName} --")
+                context_parts.append(f"Script:\n```m\n{row.Expression}\n```")
             context_parts.append("\n")
     return "\n".join(context_parts)
 
@@ -214,15 +324,18 @@ def format_metadata_for_gemini(primary_metadata: Any, file_type: str,
     context_parts.append("== End of Initial Context ==")
     return "\n".join(filter(None, context_parts))
 
-def generate_gemini_response(full_prompt: str) -> str:
+def generate_gemini_response(full_prompt: str, context_prelude: Optional[str] = None) -> str:
     global gemini_model
     if not gemini_model:
         return "Error: Gemini model is not configured."
+    cache_key = _prompt_cache_key(full_prompt); cached_text = _cached_response(cache_key)
+    if cached_text is not None: return cached_text
     try:
         # print(f"--- PROMPT SENT TO GEMINI (length: {len(full_prompt)}) ---\n{full_prompt[:2000]}...\n--- END OF PROMPT ---") # For debugging
-        response = gemini_model.generate_content(full_prompt)
+        response = _generate_content(full_prompt, context_prelude)
         # print(f"--- GEMINI RESPONSE RECEIVED ---\n{response.text[:2000]}...\n--- END OF RESPONSE ---") # For debugging
         if response.parts:
+            if _finished_with_stop(response): _remember_response(cache_key, response.text)
             return response.text
         else:
             if hasattr(response, 'prompt_feedback') and response.prompt_feedback:
@@ -233,12 +346,34 @@ def generate_gemini_response(full_prompt: str) -> str:
         # print(f"Exception during Gemini API call: {e}") # For debugging
         return f"Error during Gemini API call: {e}"
 
-def construct_initial_prompt(user_query: str, metadata_context_string: str, chat_history_string: str) -> str:
+def generate_gemini_response_stream(full_prompt: str, context_prelude: Optional[str] = None) -> Iterator[str]:
+    """Streaming variant of generate_gemini_response: yields text chunks as Gemini produces them."""
+    global gemini_model
+    if not gemini_model:
+        yield "Error: Gemini model is not configured."; return
+    cache_key = _prompt_cache_key(full_prompt); cached_text = _cached_response(cache_key)
+    if cached_text is not None: yield cached_text; return
+    try:
+        response = _generate_content(full_prompt, context_prelude, stream=True)
+        produced_chunks = []; last_chunk = None
+        for chunk in response:
+            last_chunk = chunk
+            if chunk.parts: produced_chunks.append(chunk.text); yield chunk.text
+        if produced_chunks:
+            if _finished_with_stop(last_chunk): _remember_response(cache_key, "".join(produced_chunks)) # The final chunk carries the finish_reason
+        else:
+            if hasattr(response, 'prompt_feedback') and response.prompt_feedback:
+                 block_reason = response.prompt_feedback.block_reason
+                 if block_reason: yield f"Error: The response was blocked. Reason: {block_reason}."; return
+            yield "Error: Empty or unexpected response from AI model."
+    except Exception as e:
+        yield f"Error during Gemini API call: {e}"
+
+def construct_context_prelude(metadata_context_string: str) -> str:
+    """Instructions + file metadata: the part of every prompt that stays the same across turns for one file (and is context-cached)."""
     return f"""You are PBIXpert, an expert Power BI data analyst assistant.
 Your goal is to provide insightful analysis based on the provided Power BI file context and conversation history.
 
-{chat_history_string}
-
 Context Includes: File name, type, table schemas with SMALL DATA SAMPLES for PBIX tables (first {MAX_SAMPLE_ROWS_PER_TABLE_IN_PROMPT} rows, total chars capped), DAX, relationships, M queries, and report structure if available.
 
 Your Capabilities & Behavior:
@@ -263,24 +398,27 @@ Your Capabilities & Behavior:
 Power BI File Metadata Context:
 {metadata_context_string}
 
+"""
+
+def construct_initial_prompt(user_query: str, context_prelude: str, chat_history_string: str) -> str:
+    return context_prelude + f"""{chat_history_string}
+
 Current User Query: {user_query}
 PBIXpert:
 """
 
-def construct_reprompt_with_fetched_data(user_query: str, metadata_context_string: str, chat_history_string: str,
+def construct_reprompt_with_fetched_data(user_query: str, context_prelude: str, chat_history_string: str,
                                          fetched_table_names: List[str], fetched_data_summary_string: str) -> str:
-    return f"""You are PBIXpert. You previously requested more data for the table(s): {', '.join(fetched_table_names)} to answer the user's query.
-That data has now been fetched (a sample of up to {MAX_TOOL_FETCHED_ROWS_FOR_REPROMPT} rows per table is provided below).
-Please PERFORM THE ANALYSIS using this additional data along with the original full metadata context and conversation history to answer the original user query. Present the computed results and insights directly.
+    return context_prelude + f"""{chat_history_string}
 
-{chat_history_string}
-
-Original Power BI File Metadata Context (includes initial small samples for all tables):
-{metadata_context_string}
+You previously requested more data for the table(s): {', '.join(fetched_table_names)} to answer the user's query.
+That data has now been fetched (a sample of up to {MAX_TOOL_FETCHED_ROWS_FOR_REPROMPT} rows per table is provided below as CSV).
+Please PERFORM THE ANALYSIS using this additional data along with the file metadata context above and the conversation history to answer the original user query. Present the computed results and insights directly.
+Do NOT output another TOOL_REQUEST block: answer with the data provided, explaining any remaining limitation as described above.
 
 Additional Fetched Data for Table(s) '{', '.join(fetched_table_names)}' (up to {MAX_TOOL_FETCHED_ROWS_FOR_REPROMPT} rows per table):
 {fetched_data_summary_string}
 
 Original User Query: {user_query}
 PBIXpert:
-"""
\ No newline at end of file
+"""
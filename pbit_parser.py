@@ -1,26 +1,34 @@
 import zipfile
 import json
 import os
-import shutil
-import tempfile
 import codecs
 import re # For regular expressions
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Union, BinaryIO
+try: import orjson # Optional: several times faster than the stdlib parser on the multi-MB Layout/DataModelSchema payloads
+except ImportError: orjson = None
 
 # --- Constants ---
 DATAMODEL_SCHEMA_PATH = "DataModelSchema"
 REPORT_LAYOUT_PATH = "Report/Layout"
+_JSON_DECODER = json.JSONDecoder()
 
-def strip_all_known_boms(data: bytes) -> (bytes, str):
-    """Strips all common BOMs and returns the data and detected encoding."""
+def json_loads(text: str) -> Any:
+    """json.loads via orjson when installed, falling back to the stdlib for anything orjson rejects (NaN, lone surrogates, big ints)."""
+    if orjson is not None:
+        try: return orjson.loads(text)
+        except orjson.JSONDecodeError: pass
+    return json.loads(text)
+
+def strip_all_known_boms(data: bytes) -> (memoryview, str):
+    """Strips all common BOMs and returns a zero-copy view of the data and the detected encoding."""
     bom_encodings = {
         codecs.BOM_UTF32_LE: 'utf-32-le', codecs.BOM_UTF32_BE: 'utf-32-be',
         codecs.BOM_UTF16_LE: 'utf-16-le', codecs.BOM_UTF16_BE: 'utf-16-be',
         codecs.BOM_UTF8: 'utf-8-sig'
     }
     for bom, encoding in bom_encodings.items():
-        if data.startswith(bom): return data[len(bom):], encoding
-    return data, None
+        if data.startswith(bom): return memoryview(data)[len(bom):], encoding
+    return memoryview(data), None
 
 def safe_extract_json(zip_file: zipfile.ZipFile, path: str) -> Optional[Dict[str, Any]]:
     """Safely extracts and parses a JSON file from the zip archive."""
@@ -43,7 +51,7 @@ def safe_extract_json(zip_file: zipfile.ZipFile, path: str) -> Optional[Dict[str
             content_str = None
             for enc in potential_encodings:
                 try:
-                    content_str = content_bytes_no_bom.decode(enc)
+                    content_str = codecs.decode(content_bytes_no_bom, enc) # Decodes straight from the view, no intermediate bytes copy
                     detected_encoding_final = enc
                     break
                 except UnicodeDecodeError: continue
@@ -58,15 +66,20 @@ def safe_extract_json(zip_file: zipfile.ZipFile, path: str) -> Optional[Dict[str
             elif start_json_brace != -1: start_index = start_json_brace
             elif start_json_bracket != -1: start_index = start_json_bracket
 
-            if start_index != -1:
-                cleaned_content_str = content_str[start_index:]
-            else:
+            if start_index == -1:
                 cleaned_content_str = content_str.strip()
-
-            if not cleaned_content_str:
-                # print(f"Warning: Content of {path} empty after strip.")
-                return None
-            return json.loads(cleaned_content_str)
+                if not cleaned_content_str:
+                    # print(f"Warning: Content of {path} empty after strip.")
+                    return None
+                return json_loads(cleaned_content_str)
+            if orjson is not None:
+                cleaned_content_str = content_str[start_index:]
+                return json_loads(cleaned_content_str)
+            # Stdlib only: raw_decode parses from the offset in place instead of slicing a second multi-MB copy of the document
+            cleaned_content_str = content_str
+            parsed_json, end_index = _JSON_DECODER.raw_decode(content_str, start_index)
+            if content_str[end_index:].strip(): raise json.JSONDecodeError("Extra data", content_str, end_index)
+            return parsed_json
     except KeyError: # print(f"Warning: File not found in PBIT/PBIX: {path}"); # Can be normal for PBIX
         return None
     except json.JSONDecodeError as e:
@@ -156,7 +169,7 @@ def extract_fields_from_visual_config(visual_config: Dict[str, Any], visual_leve
                     elif item.get("displayName") and isinstance(item.get("displayName"), str): fields.add(normalize_field_reference(None, item.get("displayName")))
     if visual_level_filters_str:
         try:
-            f_l = json.loads(visual_level_filters_str)
+            f_l = json_loads(visual_level_filters_str)
             if isinstance(f_l, list):
                 for f_i in f_l:
                     if isinstance(f_i, dict):
@@ -239,7 +252,7 @@ def _parse_report_layout_json_content(report_layout_json: Optional[Dict[str, Any
                     try:
                         config_str = vc.get("config", "{}"); config = {}
                         if isinstance(config_str, str) and config_str.strip():
-                            try: config = json.loads(config_str)
+                            try: config = json_loads(config_str)
                             except json.JSONDecodeError as e_json_config:
                                 # print(f"W: Inner visual JSON err p'{page_name}',v{vc_idx}:{e_json_config}. Str:{config_str[:100]}")
                                 continue
@@ -278,15 +291,21 @@ def extract_report_layout_from_zip(zip_file: zipfile.ZipFile) -> List[Dict[str,
         # print(f"W: Report/Layout issue or 'sections' key missing in {REPORT_LAYOUT_PATH} when attempting to extract.")
         return []
 
-def parse_pbit_file(pbit_file_path: str) -> Optional[Dict[str, Any]]:
+def parse_pbit_file(pbit_source: Union[str, BinaryIO], file_name: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Parses a .pbit from a file path or an in-memory binary stream (e.g. io.BytesIO).
+    `file_name` overrides the recorded name, which is otherwise taken from the path.
+    """
+    if file_name is None:
+        file_name = os.path.basename(pbit_source) if isinstance(pbit_source, str) else getattr(pbit_source, "name", "")
     extracted_metadata = {
         "tables": [], "relationships": [], "measures": {},
         "calculated_columns": {}, "report_pages": [],
         "m_queries": [],
-        "file_name": os.path.basename(pbit_file_path)
+        "file_name": file_name
     }
     try:
-        with zipfile.ZipFile(pbit_file_path, 'r') as pbit_zip:
+        with zipfile.ZipFile(pbit_source, 'r') as pbit_zip:
             data_model_json = safe_extract_json(pbit_zip, DATAMODEL_SCHEMA_PATH)
             if data_model_json and "model" in data_model_json:
                 model = data_model_json["model"]
@@ -340,17 +359,25 @@ def parse_pbit_file(pbit_file_path: str) -> Optional[Dict[str, Any]]:
                         })
             # else: print(f"W: DataModelSchema issue or 'model' key missing in {DATAMODEL_SCHEMA_PATH}.") # Reduced verbosity
 
+            # Sort once at parse time so the explorer and the Gemini context never re-sort per rerun.
+            # Report pages keep their report order; only the explorer view lists them alphabetically.
+            extracted_metadata["tables"].sort(key=lambda x: x.get("name") or "")
+            extracted_metadata["m_queries"].sort(key=lambda x: x.get("table_name") or "")
+            extracted_metadata["measures"] = dict(sorted(extracted_metadata["measures"].items())) # Dicts keep insertion order
+            extracted_metadata["calculated_columns"] = dict(sorted(extracted_metadata["calculated_columns"].items()))
+
             # Use the refactored report layout parsing
             extracted_metadata["report_pages"] = extract_report_layout_from_zip(pbit_zip)
 
         return extracted_metadata
-    except FileNotFoundError: print(f"E: PBIT file not found: {pbit_file_path}");
-    except zipfile.BadZipFile: print(f"E: Bad PBIT file (not zip): {pbit_file_path}");
+    except FileNotFoundError: print(f"E: PBIT file not found: {pbit_source}");
+    except zipfile.BadZipFile: print(f"E: Bad PBIT file (not zip): {file_name or pbit_source}");
     except Exception as e: import traceback; print(f"E during PBIT parsing: {e}"); traceback.print_exc();
     return None
 
 
 if __name__ == '__main__':
+    import shutil # Only the self-test below builds and removes a dummy archive
     dummy_pbit_path = "dummy_m_query_test.pbit"
     if not os.path.exists(dummy_pbit_path):
         print(f"Creating dummy PBIT: {dummy_pbit_path} for M query testing...")
@@ -1,4 +1,5 @@
 import zipfile
+import contextlib
 import concurrent.futures
 from .abf import parser
 from .abf.data_model import DataModel
@@ -44,7 +45,9 @@ class PbixUnpacker:
         return "unknown"
 
     def __unpack(self):
-        with zipfile.ZipFile(self.file_path, 'r') as zip_ref:
+        # Accept an already-open ZipFile (left open for the caller) so one handle can serve other readers of the same .pbix
+        zip_cm = contextlib.nullcontext(self.file_path) if isinstance(self.file_path, zipfile.ZipFile) else zipfile.ZipFile(self.file_path, 'r')
+        with zip_cm as zip_ref:
             # Open the DataModel file within the ZIP
             with zip_ref.open('DataModel') as data_model_in_pbix:
                 file_type = self.__detect_file_type(data_model_in_pbix)